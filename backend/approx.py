@@ -0,0 +1,150 @@
+import math
+import os
+import re
+from csv_handler import run_query, RESULT_ROW_LIMIT
+from sessions import SESSIONS
+
+# Approximate mode: on large datasets, answer first from a sample of the
+# rows, with COUNT/SUM scaled up and exact distinct counts and quantiles
+# swapped for their sketch-based versions, then run the exact query.
+APPROX_MIN_ROWS = int(os.getenv('APPROX_MIN_ROWS', 1_000_000))
+APPROX_SAMPLE_ROWS = int(os.getenv('APPROX_SAMPLE_ROWS', 500_000))
+APPROX_SEED = 42
+
+_CALL = re.compile(
+    r'\b(count|sum|median|quantile_cont|quantile_disc|quantile)\s*\(',
+    re.IGNORECASE)
+_DISTINCT = re.compile(r'\s*distinct\b', re.IGNORECASE)
+_TRAILER = re.compile(r'\s*(filter|over)\s*\(', re.IGNORECASE)
+_WITH = re.compile(r'^\s*with\s+(recursive\s+)?', re.IGNORECASE)
+_JOIN = re.compile(r'\bjoin\b', re.IGNORECASE)
+
+
+def approximate_sql(sql: str, row_count: int):
+    """
+    Rewrite `sql` to run on a sample of `data`. Returns (sql, info) where
+    info describes the sample and the expected error, or None when the
+    dataset is small enough to query exactly or the query can't be
+    approximated this way (joins would compound the sampling).
+    """
+    if row_count < APPROX_MIN_ROWS or _JOIN.search(sql):
+        return None
+    fraction = min(1.0, APPROX_SAMPLE_ROWS / row_count)
+    # Ratio estimator: scale by the rows actually sampled, not the nominal
+    # fraction, so whole-table counts come out exact
+    scale = f'({row_count} / NULLIF((SELECT COUNT(*) FROM data), 0))'
+
+    rewritten = _rewrite_calls(sql.strip().rstrip(';'), scale)
+    sample = (f'data AS (SELECT * FROM main.data USING SAMPLE '
+              f'{fraction * 100:.6f} PERCENT (system, {APPROX_SEED}))')
+    match = _WITH.match(rewritten)
+    if match:
+        rewritten = (f'{match.group(0)}{sample}, '
+                     f'{rewritten[match.end():]}')
+    else:
+        rewritten = f'WITH {sample} {rewritten}'
+
+    sample_rows = max(1.0, row_count * fraction)
+    return rewritten, {
+        'sample_fraction': round(fraction, 6),
+        'sample_rows':     int(sample_rows),
+        # 95% relative error of a count scaled up from the sample, for a
+        # group holding half of the rows: 1.96 * sqrt((1 - f) / n) with the
+        # finite population correction, taking the sampled rows as
+        # independent of their order in the file. Smaller groups vary more.
+        'relative_error':  round(
+            min(1.0, 1.96 * math.sqrt((1 - fraction) / sample_rows)), 4),
+        # A sample can't see every distinct value
+        'distinct_is_lower_bound': 'approx_count_distinct(' in rewritten,
+    }
+
+
+def run_sample(session_id: str, sql: str, row_count: int,
+               query_id: str = None, limit: int = RESULT_ROW_LIMIT):
+    """
+    run_query on a sample: the result, with the column names of the exact
+    query and an 'approximate' block from approximate_sql, or None if the
+    query should just run exactly.
+    """
+    approx = approximate_sql(sql, row_count)
+    if approx is None:
+        return None
+    result = run_query(session_id, approx[0], limit, query_id)
+    try:
+        with SESSIONS.use(session_id) as con:
+            names = [r[0] for r in con.execute(f'DESCRIBE {sql}').fetchall()]
+    except Exception:
+        names = []
+    if len(names) == len(result['columns']):
+        for column, name in zip(result['columns'], names):
+            column['name'] = name
+    return {**result, 'approximate': approx[1]}
+
+
+def _rewrite_calls(sql: str, scale: str) -> str:
+    out, pos = [], 0
+    for match in _CALL.finditer(sql):
+        start = match.start()
+        if start < pos or _in_string(sql, start):
+            continue
+        name = match.group(1).lower()
+        open_paren = match.end() - 1
+        close = _matching_paren(sql, open_paren)
+        if close is None:
+            break
+        args = _rewrite_calls(sql[open_paren + 1:close], scale)
+        end = close + 1
+
+        if name == 'count' and _DISTINCT.match(args):
+            call = f'approx_count_distinct({_DISTINCT.sub("", args, 1)})'
+        elif name == 'median':
+            call = f'approx_quantile({args}, 0.5)'
+        elif name.startswith('quantile'):
+            call = f'approx_quantile({args})'
+        else:
+            # Scale counts and sums, including any FILTER/OVER clause
+            trailer = _TRAILER.match(sql, end)
+            while trailer:
+                close_trailer = _matching_paren(sql, trailer.end() - 1)
+                if close_trailer is None:
+                    break
+                end = close_trailer + 1
+                trailer = _TRAILER.match(sql, end)
+            call = (f'({sql[start:open_paren]}({args}){sql[close + 1:end]}'
+                    f' * {scale})')
+            if name == 'count':
+                call = f'CAST(ROUND{call} AS BIGINT)'
+        out.append(sql[pos:start])
+        out.append(call)
+        pos = end
+    out.append(sql[pos:])
+    return ''.join(out)
+
+
+def _matching_paren(sql: str, open_paren: int):
+    depth, quote = 0, None
+    for i in range(open_paren, len(sql)):
+        ch = sql[i]
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def _in_string(sql: str, index: int) -> bool:
+    quote = None
+    for ch in sql[:index]:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+    return quote is not None
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Answers (generated SQL, chart metadata and summary) for questions already
+# asked about a dataset. Keyed on the dataset fingerprint, so identical data
+# uploaded again shares the cache, and on the normalized question.
+CACHE_PATH = os.getenv('ANSWER_CACHE_PATH', 'cache.db')
+CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 10000))
+
+_con = None
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _connection():
+    global _con
+    if _con is None:
+        _con = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _con.execute('PRAGMA journal_mode=WAL')
+        _con.execute('''
+            CREATE TABLE IF NOT EXISTS answers (
+                fingerprint TEXT,
+                question    TEXT,
+                payload     TEXT,
+                created     REAL,
+                last_used   REAL,
+                PRIMARY KEY (fingerprint, question)
+            )
+        ''')
+        _con.execute(
+            'CREATE INDEX IF NOT EXISTS answers_last_used ON answers(last_used)')
+        _con.commit()
+    return _con
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercase, strip accents and punctuation and collapse whitespace, so
+    "What's the total revenue?" and "whats the total  revenue" match.
+    """
+    q = unicodedata.normalize('NFKD', question)
+    q = ''.join(ch for ch in q if not unicodedata.combining(ch)).lower()
+    q = re.sub(r"[^\w\s]", '', q)
+    return ' '.join(q.split())
+
+
+def get_answer(fingerprint: str, question: str):
+    if not fingerprint:
+        return None
+    key = normalize_question(question)
+    now = time.time()
+    with _lock:
+        con = _connection()
+        row = con.execute(
+            'SELECT payload, created FROM answers '
+            'WHERE fingerprint=? AND question=?',
+            (fingerprint, key)).fetchone()
+        if row is None or now - row[1] > CACHE_TTL:
+            _stats['misses'] += 1
+            return None
+        con.execute(
+            'UPDATE answers SET last_used=? WHERE fingerprint=? AND question=?',
+            (now, fingerprint, key))
+        con.commit()
+        _stats['hits'] += 1
+    return json.loads(row[0])
+
+
+def put_answer(fingerprint: str, question: str, answer: dict):
+    if not fingerprint:
+        return
+    now = time.time()
+    with _lock:
+        con = _connection()
+        con.execute(
+            'INSERT OR REPLACE INTO answers VALUES (?,?,?,?,?)',
+            (fingerprint, normalize_question(question),
+             json.dumps(answer, default=str), now, now))
+        _evict(con, now)
+        con.commit()
+
+
+def _evict(con, now):
+    # Caller holds _lock. Drop expired entries, then the least recently
+    # used ones beyond the size limit.
+    expired = con.execute(
+        'DELETE FROM answers WHERE created < ?', (now - CACHE_TTL,)).rowcount
+    overflow = con.execute(
+        'DELETE FROM answers WHERE rowid IN ('
+        '  SELECT rowid FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+        (CACHE_MAX_ENTRIES,)).rowcount
+    _stats['evictions'] += expired + overflow
+
+
+def stats() -> dict:
+    with _lock:
+        entries = _connection().execute(
+            'SELECT COUNT(*) FROM answers').fetchone()[0]
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'entries':  entries,
+            'hit_rate': _stats['hits'] / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,147 @@
+import os
+import duckdb
+import numpy as np
+import pyarrow as pa
+from csv_handler import quote_ident, to_columnar
+from cursors import cursor_path
+from governor import governed
+from sessions import SESSIONS
+
+# Chart series are built on the server from the whole stored result and
+# kept small: line charts are downsampled to CHART_MAX_POINTS (LTTB keeps
+# their shape, plain bucket averages beyond CHART_LTTB_MAX_ROWS), bar and
+# pie charts keep the CHART_TOP_N largest values plus an "Other" total.
+CHART_MAX_POINTS = int(os.getenv('CHART_MAX_POINTS', 400))
+CHART_TOP_N = int(os.getenv('CHART_TOP_N', 12))
+CHART_LTTB_MAX_ROWS = int(os.getenv('CHART_LTTB_MAX_ROWS', 2_000_000))
+OTHER_LABEL = 'Other'
+
+_NUMERIC = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT',
+            'USMALLINT', 'UINTEGER', 'UBIGINT', 'FLOAT', 'DOUBLE', 'DECIMAL')
+_TEMPORAL = ('DATE', 'TIMESTAMP')
+
+
+def chart_data(session_id: str, cursor_id: str, chart_type: str,
+               x_key: str, y_key: str):
+    """
+    The chart series for a stored result as typed columns (x_key, y_key),
+    plus 'source_rows' (the rows charted) and 'method' (how they were
+    reduced, or None). None when the result has nothing to chart.
+    """
+    if chart_type not in ('bar', 'line', 'pie') or not x_key or not y_key \
+            or x_key == y_key:
+        return None
+    path = cursor_path(session_id, cursor_id)
+    if path is None:
+        return None
+    source = "read_parquet('{}', file_row_number = true)".format(
+        path.replace("'", "''"))
+    with SESSIONS.use(session_id) as con, governed(con):
+        types = {r[0]: r[1] for r in con.execute(
+            f'DESCRIBE SELECT * FROM {source}').fetchall()}
+        if x_key not in types or y_key not in types:
+            return None
+        try:
+            if chart_type == 'line':
+                table, total, method = _line(con, source, x_key, y_key,
+                                             types[x_key])
+            else:
+                table, total, method = _top_n(con, source, x_key, y_key)
+        except duckdb.Error:
+            return None
+    return {**to_columnar(table), 'source_rows': total, 'method': method}
+
+
+def _points(source, x_key, y_key, x_type):
+    """
+    SELECT of x, numeric y and the position used to order and space the
+    points: x itself when numeric or temporal, else the result's row order.
+    """
+    x = quote_ident(x_key)
+    base = x_type.split('(')[0]
+    if base in _NUMERIC:
+        position = f'CAST({x} AS DOUBLE)'
+    elif base.startswith(_TEMPORAL):
+        position = f'epoch({x})'
+    else:
+        position = 'CAST(file_row_number AS DOUBLE)'
+    return (f'SELECT * FROM (SELECT {x} AS x, '
+            f'TRY_CAST({quote_ident(y_key)} AS DOUBLE) AS y, '
+            f'{position} AS pos FROM {source}) '
+            'WHERE x IS NOT NULL AND y IS NOT NULL AND pos IS NOT NULL')
+
+
+def _line(con, source, x_key, y_key, x_type):
+    points = _points(source, x_key, y_key, x_type)
+    total = con.execute(f'SELECT COUNT(*) FROM ({points})').fetchone()[0]
+    names = f'x AS {quote_ident(x_key)}, y AS {quote_ident(y_key)}'
+    if total <= CHART_MAX_POINTS:
+        table = con.execute(
+            f'SELECT {names} FROM ({points}) ORDER BY pos').fetch_arrow_table()
+        return table, total, None
+    if total <= CHART_LTTB_MAX_ROWS:
+        table = con.execute(
+            f'SELECT {names}, pos FROM ({points}) ORDER BY pos'
+        ).fetch_arrow_table()
+        keep = _lttb(table.column('pos').to_numpy(),
+                     table.column(y_key).to_numpy(), CHART_MAX_POINTS)
+        return table.drop(['pos']).take(keep), total, 'lttb'
+    # Too many rows to pull into Python: average equal-sized runs instead
+    table = con.execute(
+        f'SELECT arg_min(x, pos) AS {quote_ident(x_key)}, '
+        f'AVG(y) AS {quote_ident(y_key)} FROM ('
+        f'SELECT *, ntile({CHART_MAX_POINTS}) OVER (ORDER BY pos) AS bucket '
+        f'FROM ({points})) GROUP BY bucket ORDER BY bucket'
+    ).fetch_arrow_table()
+    return table, total, 'bucket'
+
+
+def _lttb(x, y, threshold: int):
+    """
+    Indices of the points kept by Largest-Triangle-Three-Buckets: the first
+    and last points, and in each bucket between them the point forming the
+    largest triangle with the previous kept point and the next bucket's
+    average.
+    """
+    n = len(x)
+    if n <= threshold or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], a = 0, 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    keep[-1] = n - 1
+    return keep
+
+
+def _top_n(con, source, x_key, y_key):
+    x, y = quote_ident(x_key), quote_ident(y_key)
+    ranked = (f'SELECT *, row_number() OVER (ORDER BY y DESC) AS rank FROM ('
+              f'SELECT {x} AS x, TRY_CAST({y} AS DOUBLE) AS y, '
+              f'file_row_number FROM {source}) WHERE y IS NOT NULL')
+    total, rest, other = con.execute(
+        f'SELECT COUNT(*), COUNT(*) FILTER (WHERE rank > {CHART_TOP_N}), '
+        f'SUM(y) FILTER (WHERE rank > {CHART_TOP_N}) FROM ({ranked})'
+    ).fetchone()
+    if not rest:
+        table = con.execute(
+            f'SELECT x AS {x}, y AS {y} FROM ({ranked}) '
+            'ORDER BY file_row_number').fetch_arrow_table()
+        return table, total, None
+    # The largest values in the result's own order, then everything else
+    table = con.execute(
+        f'SELECT CAST(x AS VARCHAR) AS {x}, y AS {y} FROM ({ranked}) '
+        f'WHERE rank <= {CHART_TOP_N} ORDER BY file_row_number'
+    ).fetch_arrow_table()
+    other = pa.table({x_key: pa.array([OTHER_LABEL], table.schema[0].type),
+                      y_key: pa.array([other], table.schema[1].type)})
+    return pa.concat_tables([table, other]), total, 'top_n'
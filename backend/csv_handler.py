@@ -1,30 +1,277 @@
-import duckdb
-import uuid
 import os
 import re
-import math
-SESSIONS = {}  # session_id -> DuckDB connection
+import io
+import csv
+import json
+import hashlib
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from datasets import (content_digest, find_dataset, store_dataset,
+                      store_parquet)
+from governor import governed, check_cost
+from metrics import span, inc
+from sessions import SESSIONS
+
+# Streaming ingest settings. DuckDB's memory_limit caps the table being
+# built; INGEST_BLOCK_SIZE caps how much of the upload is parsed at once.
+INGEST_MEMORY_LIMIT = os.getenv('INGEST_MEMORY_LIMIT', '1GB')
+INGEST_BLOCK_SIZE = int(os.getenv('INGEST_BLOCK_SIZE', 8 * 1024 * 1024))
+SNIFF_BYTES = 64 * 1024
+
+# Rows returned inline by run_query; the rest are only counted
+RESULT_ROW_LIMIT = int(os.getenv('RESULT_ROW_LIMIT', 500))
+RESULT_BATCH_ROWS = 64 * 1024
+
+# Column types are guessed on a sample of this many rows, then the guess is
+# checked on the whole column
+CAST_SAMPLE_ROWS = int(os.getenv('CAST_SAMPLE_ROWS', 10_000))
+
+INGEST_PROGRESS = {}  # upload_id -> {'bytes_read', 'total_bytes', 'rows'}
+
+_MAGIC = {
+    b'\x1f\x8b':         'gzip',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+
+# Besides CSV, uploads can be Parquet, NDJSON or Excel. These are read by
+# DuckDB itself and keep their own types; only their text columns go
+# through the CSV-style auto-cast. Parquet is not read at all at upload:
+# the file is stored as it is and queried in place.
+_JSON_SUFFIXES = ('.json', '.jsonl', '.ndjson')
+_READERS = {
+    'parquet': "read_parquet('{path}')",
+    'ndjson':  "read_json('{path}', format = 'newline_delimited', "
+               "compression = '{compression}')",
+    'xlsx':    "read_xlsx('{path}')",
+}
+_FORMAT_NAMES = {'parquet': 'Parquet', 'ndjson': 'NDJSON', 'xlsx': 'Excel'}
+
+
+class _UploadReader(io.RawIOBase):
+    """
+    Read-only view over an upload that counts the (compressed) bytes
+    consumed and never closes the underlying file.
+    """
 
+    def __init__(self, file, progress=None):
+        self._file = file
+        self._progress = progress
 
-def load_csv(file_bytes: bytes, filename: str) -> dict:
-    session_id = str(uuid.uuid4())
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._file.read(len(buffer))
+        n = len(chunk)
+        buffer[:n] = chunk
+        if self._progress is not None:
+            self._progress['bytes_read'] += n
+        return n
+
+
+def load_csv(file, filename: str, upload_id: str = None,
+             total_bytes: int = None) -> dict:
+    """
+    Stream a (optionally gzip/zstd-compressed) CSV file object into a new
+    DuckDB session. The file is parsed block by block, so neither the raw
+    upload nor a temp copy of it is ever held in memory. NDJSON and Excel
+    uploads are loaded by DuckDB, and a Parquet upload becomes the session's
+    data as it is (see _attach_parquet).
+
+    A file that was uploaded before is not parsed again: the new session is
+    attached to the stored, already typed dataset.
+    """
+    with span('upload_hash'):
+        digest = content_digest(file)
+    stored = find_dataset(digest)
+    session_id = SESSIONS.create()
+    try:
+        if stored is None and _detect_format(file, filename) == 'parquet':
+            stored = _attach_parquet(file, digest, upload_id, total_bytes)
+        elif stored is None:
+            stored = _ingest_dataset(file, filename, digest, upload_id,
+                                     total_bytes, SESSIONS.path(session_id))
+        SESSIONS.update_meta(session_id, filename=filename, dataset=digest,
+                             **stored)
+    except Exception:
+        SESSIONS.drop(session_id)
+        raise
+    return {'session_id': session_id, **stored}
+
+
+def _ingest_dataset(file, filename, digest, upload_id, total_bytes,
+                    spill_dir) -> dict:
+    """
+    Parse and type the upload in a scratch database and store it as the
+    dataset `digest`, so the session database itself never holds a copy.
+    """
+    con = _scratch_connection(spill_dir)
+    try:
+        result = _ingest(con, file, filename, upload_id, total_bytes)
+        with span('upload_store'):
+            store_dataset(con, digest, result)
+    finally:
+        con.close()
+    return result
+
+
+def _attach_parquet(file, digest, upload_id, total_bytes) -> dict:
+    """
+    Store a Parquet upload as dataset `digest` without decoding it. Its
+    schema is used as it is, with no type inference, and sessions query the
+    file in place, so DuckDB only reads the columns and row groups (by
+    their min/max statistics) that a query needs. Only the profile takes a
+    scan.
+    """
+    def describe(path):
+        con = duckdb.connect()
+        try:
+            source = path.replace("'", "''")
+            try:
+                con.execute('CREATE VIEW data AS SELECT * FROM '
+                            + _READERS['parquet'].format(path=source))
+            except duckdb.Error:
+                raise ValueError('The uploaded file is not valid Parquet.')
+            SESSIONS.apply_limits(con)
+            with span('upload_profile'):
+                described = describe_data(con)
+        finally:
+            con.close()
+        return {**described, 'casts': {}, 'format': 'parquet'}
+
+    with _progress(upload_id, total_bytes) as progress, span('upload_store'):
+        return store_parquet(_UploadReader(file, progress), digest, describe)
+
+
+def _scratch_connection(spill_dir):
     con = duckdb.connect()
+    con.execute("SET temp_directory='{}'".format(
+        os.path.join(spill_dir, 'tmp').replace("'", "''")))
+    return con
 
-    tmp = f'/tmp/{session_id}.csv'
-    with open(tmp, 'wb') as f:
-        f.write(file_bytes)
 
-    # Load as all varchar first to avoid encoding/type issues
-    con.execute(
-        f"CREATE TABLE data AS SELECT * FROM read_csv_auto('{tmp}', ignore_errors=true, all_varchar=true)")
+def _ingest(con, file, filename, upload_id, total_bytes) -> dict:
+    with span('upload_parse'):
+        fmt = _load(con, file, filename, upload_id, total_bytes)
+    SESSIONS.apply_limits(con)
 
     # Now auto-detect and cast date/numeric columns
-    _auto_cast_columns(con)
+    with span('upload_cast'):
+        casts = _auto_cast_columns(con)
 
+    with span('upload_profile'):
+        described = describe_data(con)
+    return {**described, 'casts': casts, 'format': fmt}
+
+
+def _load(con, file, filename, upload_id, total_bytes) -> str:
+    """
+    Load an upload of any supported format into a `data` table on `con`
+    and return the format.
+    """
+    fmt = _detect_format(file, filename)
+    if fmt == 'csv':
+        _load_text(con, file, filename, upload_id, total_bytes)
+    else:
+        _load_file(con, file, filename, fmt, upload_id, total_bytes)
+    return fmt
+
+
+@contextmanager
+def _progress(upload_id, total_bytes):
+    """The upload's progress record, published while it is being read."""
+    progress = {'bytes_read': 0, 'total_bytes': total_bytes, 'rows': 0}
+    if upload_id:
+        INGEST_PROGRESS[upload_id] = progress
+    try:
+        yield progress
+    finally:
+        if upload_id:
+            INGEST_PROGRESS.pop(upload_id, None)
+
+
+def _load_file(con, file, filename, fmt, upload_id, total_bytes):
+    """
+    Load a Parquet, NDJSON or Excel upload into a `data` table on `con`
+    with DuckDB's reader for the format, keeping the types it reads. The
+    readers need a file, so the upload is first copied to a temp file.
+    """
+    con.execute(f"SET memory_limit='{INGEST_MEMORY_LIMIT}'")
+    directory = con.execute(
+        "SELECT current_setting('temp_directory')").fetchone()[0] or None
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        with _progress(upload_id, total_bytes) as progress:
+            compression = _detect_compression(file, filename) or 'uncompressed'
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(_UploadReader(file, progress), f,
+                                   INGEST_BLOCK_SIZE)
+            source = _READERS[fmt].format(path=path.replace("'", "''"),
+                                          compression=compression)
+            try:
+                con.execute(f'CREATE TABLE data AS SELECT * FROM {source}')
+            except duckdb.Error as e:
+                detail = str(e).splitlines()[0]
+                raise ValueError(
+                    f'Could not read the {_FORMAT_NAMES[fmt]} file: {detail}')
+            progress['rows'] = con.execute(
+                'SELECT COUNT(*) FROM data').fetchone()[0]
+    finally:
+        os.remove(path)
+
+
+def _load_text(con, file, filename, upload_id, total_bytes) -> list:
+    """
+    Stream the CSV into an all-VARCHAR `data` table on `con` and return
+    its column names.
+    """
+    con.execute(f"SET memory_limit='{INGEST_MEMORY_LIMIT}'")
+
+    with _progress(upload_id, total_bytes) as progress:
+        compression = _detect_compression(file, filename)
+        delimiter, quotechar, columns = _sniff_header(file, compression)
+
+        # Load as all varchar first to avoid encoding/type issues
+        stream = pa.input_stream(
+            _UploadReader(file, progress), compression=compression)
+        reader = pa_csv.open_csv(
+            stream,
+            read_options=pa_csv.ReadOptions(
+                column_names=columns, skip_rows=1,
+                block_size=INGEST_BLOCK_SIZE),
+            parse_options=pa_csv.ParseOptions(
+                delimiter=delimiter, quote_char=quotechar,
+                newlines_in_values=True,
+                invalid_row_handler=lambda row: 'skip'),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={c: pa.string() for c in columns},
+                strings_can_be_null=True))
+
+        cols = ', '.join(f'{quote_ident(c)} VARCHAR' for c in columns)
+        con.execute(f'CREATE TABLE data ({cols})')
+        for batch in reader:
+            con.execute('INSERT INTO data SELECT * FROM batch')
+            progress['rows'] += batch.num_rows
+    return columns
+
+
+def describe_data(con) -> dict:
+    """
+    Schema, sample rows, row count, fingerprint and a per-column profile of
+    the session's `data` table.
+    """
     schema = con.execute('DESCRIBE data').fetchdf().to_dict(orient='records')
     sample = con.execute(
         'SELECT * FROM data LIMIT 3').fetchdf().to_dict(orient='records')
-    row_count = con.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+    row_count, data_hash, profile = _profile(con, schema)
 
     # Convert sample to plain strings so JSON serialization never fails
     clean_sample = []
@@ -34,195 +281,417 @@ def load_csv(file_bytes: bytes, filename: str) -> dict:
             clean_row[k] = str(v) if v is not None else None
         clean_sample.append(clean_row)
 
-    SESSIONS[session_id] = con
-    os.remove(tmp)
-
     return {
-        'session_id': session_id,
         'schema':     schema,
         'sample':     clean_sample,
         'row_count':  row_count,
+        'fingerprint': _fingerprint(schema, row_count, data_hash),
+        'data_hash':  str(data_hash),
+        'profile':    profile,
     }
 
 
+def session_meta(session_id: str) -> dict:
+    """
+    The session's stored metadata. Sessions created before profiling was
+    added are profiled on first use.
+    """
+    meta = SESSIONS.meta(session_id)
+    if 'profile' not in meta:
+        with SESSIONS.use(session_id) as con:
+            described = describe_data(con)
+        SESSIONS.update_meta(session_id, **described)
+        meta.update(described)
+    return meta
+
+
+def append_csv(session_id: str, file, filename: str, upload_id: str = None,
+               total_bytes: int = None) -> dict:
+    """
+    Add the rows of another file (any upload format) with the same columns
+    to a session. The new rows are cast with the types chosen at upload and
+    profiled on their own; the stored profile, row count and fingerprint
+    are then merged, so the cost depends only on the size of the appended
+    file.
+    """
+    with SESSIONS.locked(session_id):
+        return _append(session_id, file, filename, upload_id, total_bytes)
+
+
+def _append(session_id, file, filename, upload_id, total_bytes) -> dict:
+    meta = session_meta(session_id)
+    schema = meta['schema']
+    name = f'{uuid.uuid4().hex}.parquet'
+    part = SESSIONS.part_file(session_id, name)
+
+    con = _scratch_connection(SESSIONS.path(session_id))
+    try:
+        with span('upload_parse'):
+            _load(con, file, filename, upload_id, total_bytes)
+        loaded = dict(con.execute(
+            'SELECT column_name, column_type FROM (DESCRIBE data)').fetchall())
+        expected = [c['column_name'] for c in schema]
+        if sorted(loaded) != sorted(expected):
+            raise ValueError(
+                'The appended file must have the same columns as the '
+                f"original: {', '.join(expected)}")
+        SESSIONS.apply_limits(con)
+        casts = meta.get('casts', {})
+        select = ', '.join(_typed_column(c['column_name'], c['column_type'],
+                                         casts, loaded[c['column_name']])
+                           for c in schema)
+        with span('upload_cast'):
+            con.execute(f'CREATE TABLE typed AS SELECT {select} FROM data')
+            con.execute('DROP TABLE data')
+            con.execute('ALTER TABLE typed RENAME TO data')
+        with span('upload_profile'):
+            rows, data_hash, profile = _profile(con, schema)
+
+        if rows:
+            os.makedirs(os.path.dirname(part), exist_ok=True)
+            target = part.replace("'", "''")
+            with span('upload_store'):
+                con.execute(f"COPY data TO '{target}' "
+                            '(FORMAT parquet, COMPRESSION zstd)')
+            merged = {
+                'parts':      meta.get('parts', []) + [name],
+                'row_count':  meta['row_count'] + rows,
+                'data_hash':  str(int(meta.get('data_hash', 0)) + data_hash),
+                'profile':    _merge_profiles(con, meta['profile'],
+                                              meta['row_count'], profile, rows),
+            }
+            merged['fingerprint'] = _fingerprint(
+                schema, merged['row_count'], merged['data_hash'])
+            # Writing the meta publishes the part: every process rebuilds
+            # its view of the session on next use
+            SESSIONS.update_meta(session_id, **merged)
+            meta.update(merged)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    finally:
+        con.close()
+    return {'session_id': session_id, 'appended_rows': rows,
+            **{k: meta[k] for k in ('schema', 'sample', 'row_count',
+                                    'fingerprint', 'profile')}}
+
+
+def _typed_column(col, dtype, casts, source_type='VARCHAR') -> str:
+    """SELECT expression giving a loaded column its stored type."""
+    quoted = quote_ident(col)
+    if dtype == source_type:
+        return quoted
+    if col in casts and source_type == 'VARCHAR':
+        expr = casts[col].format(col=quoted)
+    else:
+        expr = f'TRY_CAST({quoted} AS {dtype})'
+    return f'CAST({expr} AS {dtype}) AS {quoted}'
+
+
+def _merge_profiles(con, old, old_rows, new, new_rows) -> list:
+    """
+    Combine the profile of the stored rows with that of appended rows.
+    Counts and min/max are exact; distinct counts and top values are
+    estimates, as the sketches behind them are not kept.
+    """
+    total = old_rows + new_rows
+    bounds, params = [], []
+    for a, b in zip(old, new):
+        if 'min' in a:
+            bounds += [f'LEAST(TRY_CAST(? AS {a["type"]}), '
+                       f'TRY_CAST(? AS {a["type"]}))::VARCHAR',
+                       f'GREATEST(TRY_CAST(? AS {a["type"]}), '
+                       f'TRY_CAST(? AS {a["type"]}))::VARCHAR']
+            params += [a['min'], b['min'], a['max'], b['max']]
+    values = iter(con.execute(f"SELECT {', '.join(bounds)}", params)
+                  .fetchone() if bounds else ())
+
+    merged = []
+    for a, b in zip(old, new):
+        old_non_null = a.get('non_null',
+                             round((1 - a['null_rate']) * old_rows))
+        non_null = old_non_null + b['non_null']
+        # Near-unique columns (ids) keep adding values; others mostly repeat
+        if a['distinct'] >= 0.9 * old_non_null:
+            distinct = min(a['distinct'] + b['distinct'], non_null)
+        else:
+            distinct = max(a['distinct'], b['distinct'])
+        entry = {**a,
+                 'null_rate': round(1 - non_null / total, 4) if total else 0,
+                 'non_null':  non_null,
+                 'distinct':  distinct}
+        if 'min' in a:
+            entry['min'] = _clip(next(values))
+            entry['max'] = _clip(next(values))
+        if 'top' in a:
+            top = a['top'] + [v for v in b.get('top', []) if v not in a['top']]
+            entry['top'] = top[:PROFILE_TOP_K]
+        merged.append(entry)
+    return merged
+
+
+PROFILE_TOP_K = 5
+PROFILE_VALUE_CHARS = 40
+_ORDERED_TYPES = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT',
+                  'FLOAT', 'DOUBLE', 'DECIMAL', 'DATE', 'TIMESTAMP', 'TIME',
+                  'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT')
+
+
+def _profile(con, schema):
+    """
+    One scan over `data` for the row count, an order-independent hash of
+    every row, and per column: null rate, min/max, approximate distinct
+    count and (for text) the most common values.
+    """
+    row = ', '.join(quote_ident(c['column_name']) for c in schema)
+    aggregates = ['COUNT(*)', f'SUM(hash({row})::HUGEINT)']
+    plan = []
+    for col in schema:
+        name, dtype = col['column_name'], col['column_type']
+        quoted = quote_ident(name)
+        ordered = dtype.startswith(_ORDERED_TYPES) or dtype == 'VARCHAR'
+        parts = [f'COUNT({quoted})', f'approx_count_distinct({quoted})']
+        if ordered:
+            parts += [f'MIN({quoted})::VARCHAR', f'MAX({quoted})::VARCHAR']
+        if dtype == 'VARCHAR':
+            parts.append(f'approx_top_k({quoted}, {PROFILE_TOP_K})')
+        plan.append((name, dtype, ordered, len(parts)))
+        aggregates += parts
+
+    values = con.execute(
+        f"SELECT {', '.join(aggregates)} FROM data").fetchone()
+    row_count, data_hash = values[0], values[1]
+
+    profile, i = [], 2
+    for name, dtype, ordered, width in plan:
+        got = values[i:i + width]
+        i += width
+        entry = {
+            'name':      name,
+            'type':      dtype,
+            'null_rate': round(1 - got[0] / row_count, 4) if row_count else 0,
+            'non_null':  got[0],
+            'distinct':  got[1],
+        }
+        if ordered:
+            entry['min'] = _clip(got[2])
+            entry['max'] = _clip(got[3])
+        if dtype == 'VARCHAR':
+            entry['top'] = [_clip(v) for v in (got[4] or []) if v is not None]
+        profile.append(entry)
+    return row_count, data_hash, profile
+
+
+def _clip(value):
+    if value is None or len(value) <= PROFILE_VALUE_CHARS:
+        return value
+    return value[:PROFILE_VALUE_CHARS] + '…'
+
+
+def _fingerprint(schema, row_count, data_hash) -> str:
+    """Content hash of the dataset: its schema plus an order-independent
+    hash of every row. Identical uploads get identical fingerprints."""
+    columns = [(c['column_name'], c['column_type']) for c in schema]
+    payload = json.dumps([columns, row_count, str(data_hash)])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _detect_compression(file, filename: str):
+    """Return 'gzip', 'zstd' or None from the magic bytes (or extension)."""
+    head = file.read(4)
+    file.seek(0)
+    for magic, codec in _MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    name = (filename or '').lower()
+    if name.endswith('.gz'):
+        return 'gzip'
+    if name.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _detect_format(file, filename: str) -> str:
+    """
+    'parquet', 'xlsx', 'ndjson' or 'csv', from the magic bytes, the
+    extension or, for JSON, the first character.
+    """
+    head = file.read(4)
+    file.seek(0)
+    name = (filename or '').lower()
+    if head == b'PAR1':
+        return 'parquet'
+    if head == b'PK\x03\x04':
+        if not name.endswith('.xlsx'):
+            raise ValueError('Unsupported file type. Upload a CSV, Parquet, '
+                             'NDJSON or Excel (.xlsx) file.')
+        return 'xlsx'
+    if name.endswith(('.gz', '.zst')):
+        name = name.rsplit('.', 1)[0]
+    if name.endswith(_JSON_SUFFIXES):
+        return 'ndjson'
+    if not name.endswith(('.csv', '.tsv', '.txt')):
+        compression = _detect_compression(file, filename)
+        stream = pa.input_stream(_UploadReader(file), compression=compression)
+        first = stream.read(SNIFF_BYTES).lstrip(b'\xef\xbb\xbf \t\r\n')[:1]
+        stream.close()
+        file.seek(0)
+        if first == b'{':
+            return 'ndjson'
+    return 'csv'
+
+
+def _sniff_header(file, compression):
+    """
+    Detect the delimiter/quote character and read the header row from the
+    first few KB of the decompressed upload, then rewind the file.
+    """
+    stream = pa.input_stream(_UploadReader(file), compression=compression)
+    head = stream.read(SNIFF_BYTES).decode('utf-8', errors='replace')
+    stream.close()
+    file.seek(0)
+
+    head = head.lstrip('\ufeff')
+    if '\n' in head:
+        head = head[:head.rindex('\n') + 1]
+    try:
+        dialect = csv.Sniffer().sniff(head, delimiters=',;\t|')
+        delimiter, quotechar = dialect.delimiter, dialect.quotechar or '"'
+    except csv.Error:
+        delimiter, quotechar = ',', '"'
+
+    header = next(csv.reader(io.StringIO(head), delimiter=delimiter,
+                             quotechar=quotechar), [])
+    if not header:
+        raise ValueError('The uploaded file is empty.')
+
+    # Make column names unique and non-empty, like read_csv_auto does
+    columns, seen = [], set()
+    for i, name in enumerate(header):
+        name = name.strip() or f'column{i}'
+        base, n = name, 1
+        while name in seen:
+            name = f'{base}_{n}'
+            n += 1
+        seen.add(name)
+        columns.append(name)
+    return delimiter, quotechar, columns
+
+
+# Candidate conversions for VARCHAR columns, in order of preference.
+# The first one that parses at least 95% of the non-empty values wins.
+CAST_CANDIDATES = [
+    # M/D/YYYY (e.g. Superstore, US government datasets)
+    ('TIMESTAMP', "TRY_STRPTIME({col}, '%m/%d/%Y')"),
+    # YYYY-MM-DD (ISO standard, most common)
+    ('TIMESTAMP', "TRY_STRPTIME({col}, '%Y-%m-%d')"),
+    # DD/MM/YYYY (European datasets)
+    ('TIMESTAMP', "TRY_STRPTIME({col}, '%d/%m/%Y')"),
+    # MM-DD-YYYY
+    ('TIMESTAMP', "TRY_STRPTIME({col}, '%m-%d-%Y')"),
+    # YYYY-MM-DD HH:MM:SS (datetime with time)
+    ('TIMESTAMP', "TRY_STRPTIME({col}, '%Y-%m-%d %H:%M:%S')"),
+    # Generic timestamp cast
+    ('TIMESTAMP', 'TRY_CAST({col} AS TIMESTAMP)'),
+    ('DOUBLE',    'TRY_CAST({col} AS DOUBLE)'),
+    ('BIGINT',    'TRY_CAST({col} AS BIGINT)'),
+]
+
+
 def _auto_cast_columns(con):
     """
     Try to cast VARCHAR columns to proper types (TIMESTAMP, DATE, DOUBLE, BIGINT).
     Handles common date formats including M/D/YYYY used in US datasets.
+
+    Every candidate is scored on a sample of CAST_SAMPLE_ROWS rows; only the
+    candidates that pass there are checked on the full table, in a single
+    aggregate scan. All casts are then applied in one CREATE TABLE ... AS
+    SELECT rewrite. Returns the chosen cast per column, as a
+    CAST_CANDIDATES template.
     """
     schema = con.execute('DESCRIBE data').fetchdf()
     columns = schema['column_name'].tolist()
     types = schema['column_type'].tolist()
 
-    for col, dtype in zip(columns, types):
-        if dtype != 'VARCHAR':
-            continue
-
-        safe_col = col.replace('"', '""')
+    varchar_cols = [c for c, t in zip(columns, types) if t == 'VARCHAR']
+    if not varchar_cols:
+        return {}
 
-        # Try M/D/YYYY format (e.g. Superstore, US government datasets)
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_STRPTIME("{safe_col}", '%m/%d/%Y') IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(f"""
-                    ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP
-                    USING TRY_STRPTIME("{safe_col}", '%m/%d/%Y')
-                """)
-                continue
-        except Exception:
-            pass
-
-        # Try YYYY-MM-DD format (ISO standard, most common)
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_STRPTIME("{safe_col}", '%Y-%m-%d') IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(f"""
-                    ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP
-                    USING TRY_STRPTIME("{safe_col}", '%Y-%m-%d')
-                """)
-                continue
-        except Exception:
-            pass
-
-        # Try DD/MM/YYYY format (European datasets)
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_STRPTIME("{safe_col}", '%d/%m/%Y') IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(f"""
-                    ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP
-                    USING TRY_STRPTIME("{safe_col}", '%d/%m/%Y')
-                """)
-                continue
-        except Exception:
-            pass
-
-        # Try MM-DD-YYYY format
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_STRPTIME("{safe_col}", '%m-%d-%Y') IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(f"""
-                    ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP
-                    USING TRY_STRPTIME("{safe_col}", '%m-%d-%Y')
-                """)
-                continue
-        except Exception:
-            pass
-
-        # Try YYYY-MM-DD HH:MM:SS format (datetime with time)
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_STRPTIME("{safe_col}", '%Y-%m-%d %H:%M:%S') IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(f"""
-                    ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP
-                    USING TRY_STRPTIME("{safe_col}", '%Y-%m-%d %H:%M:%S')
-                """)
-                continue
-        except Exception:
-            pass
-
-        # Try generic TIMESTAMP cast
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_CAST("{safe_col}" AS TIMESTAMP) IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(
-                    f'ALTER TABLE data ALTER "{safe_col}" TYPE TIMESTAMP USING TRY_CAST("{safe_col}" AS TIMESTAMP)')
-                continue
-        except Exception:
-            pass
-
-        # Try DOUBLE
-        try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_CAST("{safe_col}" AS DOUBLE) IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(
-                    f'ALTER TABLE data ALTER "{safe_col}" TYPE DOUBLE USING TRY_CAST("{safe_col}" AS DOUBLE)')
-                continue
-        except Exception:
-            pass
-
-        # Try BIGINT
+    try:
+        rows = con.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+        if rows <= CAST_SAMPLE_ROWS:
+            # Small enough that the sample would be the whole table
+            return _apply_casts(con, columns, _score_casts(
+                con, 'data', {c: CAST_CANDIDATES for c in varchar_cols}))
+        sample = ', '.join(quote_ident(c) for c in varchar_cols)
+        con.execute(
+            f"CREATE OR REPLACE TEMP TABLE cast_sample AS SELECT {sample} "
+            f"FROM data USING SAMPLE reservoir({CAST_SAMPLE_ROWS} ROWS) "
+            f"REPEATABLE (0)")
         try:
-            result = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL
-                AND TRY_CAST("{safe_col}" AS BIGINT) IS NULL
-                AND "{safe_col}" != ''
-            """).fetchone()[0]
-            total = con.execute(f"""
-                SELECT COUNT(*) FROM data
-                WHERE "{safe_col}" IS NOT NULL AND "{safe_col}" != ''
-            """).fetchone()[0]
-            if total > 0 and result / total < 0.05:
-                con.execute(
-                    f'ALTER TABLE data ALTER "{safe_col}" TYPE BIGINT USING TRY_CAST("{safe_col}" AS BIGINT)')
-        except Exception:
-            pass
-
-
-def _fix_sql(sql: str) -> str:
+            plausible = _score_casts(
+                con, 'cast_sample',
+                {c: CAST_CANDIDATES for c in varchar_cols}, keep_all=True)
+        finally:
+            con.execute('DROP TABLE IF EXISTS cast_sample')
+        casts = _score_casts(con, 'data', plausible) if plausible else {}
+    except Exception:
+        return {}
+    return _apply_casts(con, columns, casts)
+
+
+def _score_casts(con, table, candidates, keep_all=False):
+    """
+    Count in one scan of `table` how many non-empty values of each column
+    every one of its candidates parses. Returns, per column, the first
+    candidate that parses at least 95% of them, or with `keep_all` every
+    such candidate. Columns without non-empty values are left out.
+    """
+    aggregates, layout = [], []
+    for col, options in candidates.items():
+        quoted = quote_ident(col)
+        present = f"{quoted} IS NOT NULL AND {quoted} != ''"
+        aggregates.append(f"SUM(CASE WHEN {present} THEN 1 ELSE 0 END)")
+        for _, expr in options:
+            aggregates.append(
+                f"SUM(CASE WHEN {present} AND {expr.format(col=quoted)} "
+                f"IS NOT NULL THEN 1 ELSE 0 END)")
+        layout.append((col, options))
+    counts = iter(con.execute(
+        f"SELECT {', '.join(aggregates)} FROM {table}").fetchone())
+
+    chosen = {}
+    for col, options in layout:
+        total = next(counts)
+        passing = [candidate for candidate, ok in zip(options, counts)
+                   if total and (total - ok) / total < 0.05]
+        if passing:
+            chosen[col] = passing if keep_all else passing[0][1]
+    return chosen
+
+
+def _apply_casts(con, columns, casts):
+    if not casts:
+        return casts
+
+    select = []
+    for col in columns:
+        if col in casts:
+            select.append(
+                f'{casts[col].format(col=quote_ident(col))} AS {quote_ident(col)}')
+        else:
+            select.append(quote_ident(col))
+    con.execute(
+        f"CREATE OR REPLACE TABLE data AS SELECT {', '.join(select)} FROM data")
+    return casts
+
+
+def quote_ident(col: str) -> str:
+    return '"' + col.replace('"', '""') + '"'
+
+
+def fix_sql(sql: str) -> str:
     """
     Clean up common AI-generated SQL issues for DuckDB compatibility.
     """
@@ -281,15 +750,42 @@ def _fix_sql(sql: str) -> str:
     return sql
 
 
-def run_query(session_id: str, sql: str):
-    con = SESSIONS.get(session_id)
-    if not con:
-        raise ValueError('Session expired. Please re-upload your file.')
+def run_query(session_id: str, sql: str, limit: int = RESULT_ROW_LIMIT,
+              query_id: str = None):
+    """
+    Run the SQL and return the first `limit` rows as typed columns:
+    {'columns': [{'name', 'type'}], 'data': [[...] per column], 'total_rows'}
+    """
+    with SESSIONS.use(session_id) as con, governed(con, query_id):
+        return _run_query(con, sql, limit)
 
-    sql = _fix_sql(sql)
+
+def _run_query(con, sql: str, limit: int):
+    with span('query_execute'):
+        reader, _ = execute_with_fallback(
+            con, sql, lambda q: _execute(con, q).fetch_record_batch(
+                RESULT_BATCH_ROWS))
+        return _collect(reader, limit)
+
+
+def _execute(con, sql: str):
+    check_cost(con, sql)
+    return con.execute(sql)
+
+
+def execute_with_fallback(con, sql: str, execute):
+    """
+    Clean up the model's SQL and call execute(sql), retrying once with
+    date columns wrapped in TRY_CAST if a date function failed.
+    Returns (execute's result, the SQL that succeeded).
+    """
+    with span('sql_fix'):
+        sql = fix_sql(sql)
 
     try:
-        df = con.execute(sql).fetchdf()
+        return execute(sql), sql
+    except ValueError:
+        raise  # already a user-facing error (e.g. rejected by the governor)
     except Exception as e:
         error_msg = str(e)
 
@@ -313,8 +809,9 @@ def run_query(session_id: str, sql: str):
                     m.group(2), f"TRY_CAST({m.group(2)} AS TIMESTAMP)"),
                 sql_fixed
             )
+            inc('querymind_sql_retries_total')
             try:
-                df = con.execute(sql_fixed).fetchdf()
+                return execute(sql_fixed), sql_fixed
             except Exception:
                 raise ValueError(f"Query failed: {error_msg}")
 
@@ -324,14 +821,60 @@ def run_query(session_id: str, sql: str):
         else:
             raise ValueError(f"Query failed: {error_msg}")
 
-    # Convert all values to JSON-safe types, handling NaN and Infinity
-    result = []
-    for record in df.to_dict(orient='records'):
-        clean = {}
-        for k, v in record.items():
-            if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
-                clean[k] = None
-            else:
-                clean[k] = str(v) if v is not None else None
-        result.append(clean)
-    return result
+
+def _collect(reader, limit: int) -> dict:
+    """
+    Keep the first `limit` rows of an Arrow batch stream and count the rest
+    without converting them to Python objects.
+    """
+    batches, kept, total = [], 0, 0
+    for batch in reader:
+        total += batch.num_rows
+        if kept < limit:
+            batch = batch.slice(0, limit - kept)
+            batches.append(batch)
+            kept += batch.num_rows
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    with span('to_columnar'):
+        columns = to_columnar(table)
+    return {**columns, 'total_rows': total}
+
+
+def to_columnar(table) -> dict:
+    """Convert an Arrow table to JSON-safe typed columns."""
+    columns, data = [], []
+    for field, column in zip(table.schema, table.columns):
+        columns.append({'name': field.name, 'type': str(field.type)})
+        data.append(_json_values(column))
+    return {'columns': columns, 'data': data}
+
+
+def _json_values(column) -> list:
+    t = column.type
+    if pa.types.is_floating(t):
+        # NaN and Infinity are not valid JSON
+        column = pc.if_else(pc.is_finite(column), column, None)
+    elif pa.types.is_decimal(t):
+        column = column.cast(pa.float64())
+    elif pa.types.is_timestamp(t) or pa.types.is_date(t) \
+            or pa.types.is_time(t):
+        return [v.isoformat() if v is not None else None
+                for v in column.to_pylist()]
+    elif not (pa.types.is_integer(t) or pa.types.is_boolean(t)
+              or pa.types.is_string(t) or pa.types.is_large_string(t)
+              or pa.types.is_null(t)):
+        return [str(v) if v is not None else None
+                for v in column.to_pylist()]
+    return column.to_pylist()
+
+
+def to_records(result: dict, limit: int = None) -> list:
+    """Row dicts for the first `limit` rows of a run_query result."""
+    names = [c['name'] for c in result['columns']]
+    rows = zip(*result['data']) if result['data'] else []
+    records = []
+    for row in rows:
+        if limit is not None and len(records) >= limit:
+            break
+        records.append(dict(zip(names, row)))
+    return records
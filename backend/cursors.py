@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import nullcontext
+from csv_handler import (execute_with_fallback, fix_sql, quote_ident,
+                         to_columnar, RESULT_ROW_LIMIT)
+from executor import run_db_batch
+from governor import governed, check_cost
+from metrics import span, capture_profile, note
+from results import result_key, lookup, store
+from sessions import SESSIONS
+
+# A cursor is a query result materialized as a Parquet file inside the
+# session directory. Pages are read back with DuckDB, so neither the server
+# nor the client ever holds more than one page in memory.
+CURSOR_TTL = int(os.getenv('CURSOR_TTL', 3600))
+CURSOR_MAX_PER_SESSION = int(os.getenv('CURSOR_MAX_PER_SESSION', 20))
+CURSOR_MAX_BYTES = int(os.getenv('CURSOR_MAX_MB', 1024)) * 1024 * 1024
+MAX_PAGE_SIZE = 1000
+# Queries of one batch (open_cursors) run at the same time
+BATCH_PARALLELISM = int(os.getenv('BATCH_PARALLELISM', 4))
+
+FILTER_OPS = {
+    '=':        '{col} = ?',
+    '!=':       '{col} != ?',
+    '<':        '{col} < ?',
+    '<=':       '{col} <= ?',
+    '>':        '{col} > ?',
+    '>=':       '{col} >= ?',
+    'contains': "CAST({col} AS VARCHAR) ILIKE '%' || ? || '%'",
+    'is_null':  '{col} IS NULL',
+    'not_null': '{col} IS NOT NULL',
+}
+
+
+def _cursor_dir(session_id: str) -> str:
+    return os.path.join(SESSIONS.path(session_id), 'cursors')
+
+
+def _cursor_file(session_id: str, cursor_id: str) -> str:
+    if not re.fullmatch(r'[0-9a-f]{32}', cursor_id or ''):
+        raise ValueError('Result expired. Please run the query again.')
+    return os.path.join(_cursor_dir(session_id), f'{cursor_id}.parquet')
+
+
+def open_cursor(session_id: str, sql: str,
+                page_size: int = RESULT_ROW_LIMIT,
+                query_id: str = None, explain: bool = False) -> dict:
+    """
+    Run the SQL once, store the full result as a cursor and return its id,
+    the exact row count and the first page. The run is bounded by the
+    query governor and can be stopped with governor.cancel(query_id).
+    With `explain`, DuckDB's profile of the run (what EXPLAIN ANALYZE
+    shows) is returned as query_profile.
+
+    The same SQL on the same data is answered from the result cache.
+    """
+    with SESSIONS.use(session_id) as con:
+        result = _open(con, session_id, sql, page_size, query_id, explain)
+    _expire(session_id, keep={result['cursor_id']})
+    return result
+
+
+async def open_cursors(session_id: str, sqls: list,
+                       page_size: int = RESULT_ROW_LIMIT,
+                       query_id: str = None) -> list:
+    """
+    open_cursor for several queries on one session, such as the widgets of
+    a dashboard. Each distinct SQL runs once as its own job on the worker
+    pool, up to BATCH_PARALLELISM at a time on their own cursors of the
+    session's connection; with a query_id, the i-th can be cancelled as
+    f'{query_id}-{i}'. Returns a result per SQL, or the ValueError it
+    failed with.
+    """
+    distinct = list(dict.fromkeys(sqls))
+    if not distinct:
+        return []
+    results = dict(zip(distinct, await run_db_batch(session_id, [
+        functools.partial(_open_batched, session_id, sql, page_size,
+                          query_id and f'{query_id}-{i}')
+        for i, sql in enumerate(distinct)], BATCH_PARALLELISM)))
+    await asyncio.to_thread(_expire, session_id,
+                            {r['cursor_id'] for r in results.values()
+                             if isinstance(r, dict)})
+    return [results[sql] for sql in sqls]
+
+
+def _open_batched(session_id, sql, page_size, query_id):
+    with SESSIONS.use(session_id) as con:
+        cursor = con.cursor()
+        try:
+            return _open(cursor, session_id, sql, page_size, query_id)
+        except ValueError as e:
+            return e
+        finally:
+            cursor.close()
+
+
+def _open(con, session_id, sql, page_size, query_id, explain=False):
+    cursor_id = uuid.uuid4().hex
+    profile = {}
+    key = result_key(SESSIONS.fingerprint(session_id), fix_sql(sql))
+    os.makedirs(_cursor_dir(session_id), exist_ok=True)
+    path = _cursor_file(session_id, cursor_id)
+    target = path.replace("'", "''")
+
+    def copy(q):
+        check_cost(con, q)
+        con.execute(f"COPY ({q}) TO '{target}' (FORMAT parquet)")
+
+    # Profiling means running the query, so it skips the cache
+    cached = None if explain else lookup(key, path)
+    note(result_cache='hit' if cached else 'miss')
+    if cached:
+        sql, total = cached['sql'], cached['total_rows']
+    else:
+        try:
+            with span('query_execute'), governed(con, query_id), \
+                    (capture_profile(con, profile) if explain
+                     else nullcontext()):
+                _, sql = execute_with_fallback(con, sql, copy)
+        except Exception:
+            _remove(path)
+            raise
+        total = con.execute(
+            f"SELECT COALESCE(SUM(num_rows), 0) "
+            f"FROM parquet_file_metadata('{target}')").fetchone()[0]
+        store(key, path, {'sql': sql, 'total_rows': total})
+    with open(path[:-len('.parquet')] + '.json', 'w') as f:
+        json.dump({'sql': sql, 'total_rows': total,
+                   'created': time.time()}, f)
+    with span('query_first_page'):
+        page = _read_page(con, path, 0, page_size, None, False, [])
+    result = {'cursor_id': cursor_id, **page, 'total_rows': total}
+    if explain:
+        result['query_profile'] = profile.get('plan')
+    return result
+
+
+def cursor_path(session_id: str, cursor_id: str):
+    """The cursor's Parquet file, or None if it has expired."""
+    try:
+        path = _cursor_file(session_id, cursor_id)
+    except ValueError:
+        return None
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return path
+
+
+def cursor_info(path: str) -> dict:
+    """A cursor file's sidecar: the SQL it was made by and its row count."""
+    try:
+        with open(path[:-len('.parquet')] + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def fetch_page(session_id: str, cursor_id: str, offset: int = 0,
+               limit: int = 100, sort_by: str = None,
+               descending: bool = False, filters: list = ()) -> dict:
+    """
+    Read one page of a cursor, optionally sorted by a column and filtered
+    with [{'column', 'op', 'value'}] conditions. total_rows counts the
+    rows that match the filters.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    with SESSIONS.use(session_id) as con:
+        path = _cursor_file(session_id, cursor_id)
+        if not os.path.exists(path):
+            raise ValueError('Result expired. Please run the query again.')
+        os.utime(path)  # expiry counts from the last access
+        with span('page_read'), governed(con):
+            return _read_page(con, path, max(0, offset), limit,
+                              sort_by, descending, filters)
+
+
+def _read_page(con, path, offset, limit, sort_by, descending, filters):
+    source = "read_parquet('{}')".format(path.replace("'", "''"))
+    columns = [r[0] for r in con.execute(
+        f'DESCRIBE SELECT * FROM {source}').fetchall()]
+
+    where, params = [], []
+    for f in filters:
+        col, op = f.get('column'), f.get('op', '=')
+        if col not in columns or op not in FILTER_OPS:
+            raise ValueError(f'Invalid filter: {col} {op}')
+        where.append(FILTER_OPS[op].format(col=quote_ident(col)))
+        if op not in ('is_null', 'not_null'):
+            params.append(f.get('value'))
+    where_sql = f" WHERE {' AND '.join(where)}" if where else ''
+
+    order_sql = ''
+    if sort_by:
+        if sort_by not in columns:
+            raise ValueError(f'Unknown column: {sort_by}')
+        order_sql = (f" ORDER BY {quote_ident(sort_by)} "
+                     f"{'DESC' if descending else 'ASC'} NULLS LAST")
+
+    total = con.execute(
+        f'SELECT COUNT(*) FROM {source}{where_sql}', params).fetchone()[0]
+    table = con.execute(
+        f'SELECT * FROM {source}{where_sql}{order_sql} LIMIT ? OFFSET ?',
+        params + [limit, offset]).fetch_arrow_table()
+    return {**to_columnar(table), 'offset': offset, 'total_rows': total}
+
+
+def _expire(session_id: str, keep=()):
+    """
+    Delete cursors not read for CURSOR_TTL seconds, then the least recently
+    read ones beyond the per-session count and size limits.
+    """
+    directory = _cursor_dir(session_id)
+    now = time.time()
+    cursors = []
+    for name in os.listdir(directory):
+        if not name.endswith('.parquet'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        cursors.append((st.st_mtime, st.st_size, name[:-len('.parquet')]))
+    cursors.sort(reverse=True)  # most recently used first
+
+    count, size = 0, 0
+    for mtime, nbytes, cursor_id in cursors:
+        count += 1
+        size += nbytes
+        if cursor_id in keep:
+            continue
+        if (now - mtime > CURSOR_TTL or count > CURSOR_MAX_PER_SESSION
+                or size > CURSOR_MAX_BYTES):
+            _remove(os.path.join(directory, cursor_id + '.parquet'))
+            count -= 1
+            size -= nbytes
+
+
+def _remove(path: str):
+    """Delete a cursor's Parquet file and its sidecar, if present."""
+    for p in (path, path[:-len('.parquet')] + '.json'):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
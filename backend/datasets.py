@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+# Uploaded data is stored once per distinct file, as typed Parquet, under
+# the sha256 of the raw upload. Sessions only reference it, so
+# re-uploading the same export attaches to the stored dataset instead of
+# parsing and casting it again. Parquet uploads are kept as they are.
+DATASET_DIR = os.getenv('DATASET_DIR', 'datasets')
+HASH_CHUNK = 8 * 1024 * 1024
+
+
+def content_digest(file) -> str:
+    """sha256 of an upload's raw bytes; the file is rewound afterwards."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(HASH_CHUNK), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def _dataset_dir(digest: str) -> str:
+    return os.path.join(DATASET_DIR, digest)
+
+
+def dataset_file(digest: str) -> str:
+    return os.path.abspath(os.path.join(_dataset_dir(digest), 'data.parquet'))
+
+
+def find_dataset(digest: str):
+    """The stored description (schema, profile...) of a dataset, or None."""
+    try:
+        with open(os.path.join(_dataset_dir(digest), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if os.path.exists(dataset_file(digest)) else None
+
+
+def store_dataset(con, digest: str, described: dict):
+    """Persist the freshly ingested `data` table on `con` as dataset `digest`."""
+    def write(path):
+        target = path.replace("'", "''")
+        con.execute(
+            f"COPY data TO '{target}' (FORMAT parquet, COMPRESSION zstd)")
+        return described
+    return _store(digest, write)
+
+
+def store_parquet(file, digest: str, describe) -> dict:
+    """
+    Keep an uploaded Parquet file as dataset `digest` exactly as uploaded,
+    and return its description, `describe(path)` of the written file.
+    """
+    def write(path):
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(file, f, HASH_CHUNK)
+        return describe(path)
+    return _store(digest, write)
+
+
+def _store(digest: str, write) -> dict:
+    """
+    Write a dataset to a temp directory with `write(parquet_path)`, which
+    returns its description, then move it into place.
+    """
+    os.makedirs(DATASET_DIR, exist_ok=True)
+    tmp = os.path.join(DATASET_DIR, f'.{digest}.{uuid.uuid4().hex}')
+    os.makedirs(tmp)
+    try:
+        described = write(os.path.join(tmp, 'data.parquet'))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(described, f, default=str)
+        try:
+            os.rename(tmp, _dataset_dir(digest))
+        except OSError:
+            # Stored concurrently by an identical upload: use that one,
+            # unless what is there is an incomplete leftover.
+            if find_dataset(digest) is None:
+                shutil.rmtree(_dataset_dir(digest), ignore_errors=True)
+                os.rename(tmp, _dataset_dir(digest))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return described
@@ -1,11 +1,38 @@
+import atexit
+import logging
+import queue
 import sqlite3
+import threading
+import time
 from datetime import datetime
 
 DB_PATH = 'history.db'
 
+# Inserts are queued and group-committed by one writer thread, so request
+# handlers never wait on SQLite locks. Reads use one connection per thread;
+# WAL mode lets them run while the writer commits.
+WRITE_BATCH_SIZE = 500
+WRITE_RETRIES = 3
+INSERT = 'INSERT INTO history VALUES (NULL,?,?,?,?,?,?,?)'
+
+log = logging.getLogger('querymind.history')
+_writes = queue.Queue()
+_pending = {}  # session_id -> rows queued but not yet committed
+_committed = threading.Condition()
+_readers = threading.local()
+_writer = None
+
+
+def _connect():
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    return con
+
 
 def init_db():
-    con = sqlite3.connect(DB_PATH)
+    global _writer
+    con = _connect()
     con.execute('''
         CREATE TABLE IF NOT EXISTS history (
             id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -18,25 +45,127 @@ def init_db():
             timestamp   TEXT
         )
     ''')
+    con.execute('''
+        CREATE INDEX IF NOT EXISTS history_session_time
+        ON history(session_id, timestamp)
+    ''')
     con.commit()
+    con.close()
+
+    if _writer is None:
+        _writer = threading.Thread(target=_write_loop, name='history-writer',
+                                   daemon=True)
+        _writer.start()
+        atexit.register(flush)
+
+
+def _write_loop():
+    con = _connect()
+    while True:
+        batch = [_writes.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_writes.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _commit(con, batch)
+        finally:
+            with _committed:
+                for row in batch:
+                    _pending[row[0]] -= 1
+                    if not _pending[row[0]]:
+                        del _pending[row[0]]
+                _committed.notify_all()
+            for _ in batch:
+                _writes.task_done()
+
+
+def _commit(con, batch):
+    """
+    Insert a batch in one transaction, retrying while the database is
+    busy. If it still fails, rows are inserted one by one so a bad row only
+    loses itself, and every lost row is logged.
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            con.executemany(INSERT, batch)
+            con.commit()
+            return
+        except sqlite3.OperationalError as e:  # locked, busy, disk I/O
+            con.rollback()
+            log.warning('History batch of %d rows failed (%s), retrying',
+                        len(batch), e)
+            time.sleep(0.1 * (attempt + 1))
+        except sqlite3.Error:
+            con.rollback()
+            break
+    for row in batch:
+        try:
+            con.execute(INSERT, row)
+            con.commit()
+        except sqlite3.Error:
+            con.rollback()
+            log.exception('Dropped history row of session %s', row[0])
 
 
 def save_query(session_id, question, sql, summary, row_count, chart_type):
-    con = sqlite3.connect(DB_PATH)
-    con.execute(
-        'INSERT INTO history VALUES (NULL,?,?,?,?,?,?,?)',
-        (session_id, question, sql, summary,
-         row_count, chart_type, datetime.now().isoformat())
-    )
-    con.commit()
+    """Queue a history row; it is committed with the next batch."""
+    with _committed:
+        _pending[session_id] = _pending.get(session_id, 0) + 1
+    _writes.put((session_id, question, sql, summary,
+                 row_count, chart_type, datetime.now().isoformat()))
+
+
+def flush():
+    """Block until every queued history row has been committed."""
+    _writes.join()
+
+
+def _wait_for(session_id):
+    """Block until the session's queued history rows have been committed."""
+    with _committed:
+        _committed.wait_for(lambda: session_id not in _pending)
+
+
+def _reader():
+    con = getattr(_readers, 'con', None)
+    if con is None:
+        con = _readers.con = _connect()
+    return con
+
+
+def ran_query(session_id, sql) -> bool:
+    """Whether the session has a history row for exactly this SQL."""
+    _wait_for(session_id)
+    return _reader().execute(
+        'SELECT 1 FROM history WHERE session_id=? AND sql=? LIMIT 1',
+        (session_id, sql)).fetchone() is not None
 
 
-def get_history(session_id, limit=20):
-    con = sqlite3.connect(DB_PATH)
-    rows = con.execute(
-        'SELECT * FROM history WHERE session_id=? ORDER BY timestamp DESC LIMIT ?',
-        (session_id, limit)
-    ).fetchall()
+def get_history(session_id, limit=20, before_id=None):
+    """
+    Most recent queries first. Pass the id of the last row of a page as
+    before_id to get the next page (keyset pagination on the
+    (session_id, timestamp) index, so deep pages stay cheap). Waits for
+    the session's own queued rows only, not for other sessions' writes.
+    """
+    _wait_for(session_id)
+    if before_id is None:
+        rows = _reader().execute(
+            'SELECT * FROM history WHERE session_id=? '
+            'ORDER BY timestamp DESC, id DESC LIMIT ?',
+            (session_id, limit)
+        ).fetchall()
+    else:
+        rows = _reader().execute(
+            'SELECT h.* FROM history h, '
+            '  (SELECT timestamp, id FROM history WHERE id=?) AS last '
+            'WHERE h.session_id=? '
+            '  AND (h.timestamp, h.id) < (last.timestamp, last.id) '
+            'ORDER BY h.timestamp DESC, h.id DESC LIMIT ?',
+            (before_id, session_id, limit)
+        ).fetchall()
     keys = ['id', 'session_id', 'question', 'sql',
             'summary', 'row_count', 'chart_type', 'timestamp']
     return [dict(zip(keys, r)) for r in rows]
@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# DuckDB work runs here instead of on the event loop. Jobs for the same
+# session are serialized (a DuckDB connection is not safe to share between
+# threads); jobs for different sessions run in parallel.
+DB_WORKERS = int(os.getenv('DB_WORKERS', os.cpu_count() or 4))
+MAX_PENDING_JOBS = int(os.getenv('MAX_PENDING_JOBS', DB_WORKERS * 8))
+MAX_SESSION_JOBS = int(os.getenv('MAX_SESSION_JOBS', 4))
+
+POOL = ThreadPoolExecutor(max_workers=DB_WORKERS,
+                          thread_name_prefix='duckdb')
+
+_pending = 0
+_session_locks = {}  # session_id -> [asyncio.Lock, jobs waiting or running]
+
+
+class Overloaded(Exception):
+    """Raised when a job is refused because the queue is full."""
+
+
+async def run_db(session_id, fn, *args, **kwargs):
+    """
+    Run a blocking DuckDB call on the worker pool and await its result.
+
+    session_id may be None for work that does not touch an existing
+    session (e.g. loading a new upload).
+    """
+    entry = _admit(session_id, 1)
+    try:
+        call = _in_context(fn, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        if entry is None:
+            return await loop.run_in_executor(POOL, call)
+        async with entry[0]:
+            return await loop.run_in_executor(POOL, call)
+    finally:
+        _leave(session_id, entry, 1)
+
+
+async def run_db_batch(session_id, calls, parallelism):
+    """
+    Run blocking calls of one session on the worker pool, up to
+    `parallelism` at a time, and return their results in order. Only for
+    calls that are safe side by side, e.g. each on its own cursor of the
+    session's connection. Every call counts as a pending job until the
+    batch is done; the batch takes the session's turn like a single job.
+    """
+    entry = _admit(session_id, len(calls))
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(parallelism)
+
+    async def run(fn):
+        try:
+            async with limit:
+                return None, await loop.run_in_executor(POOL,
+                                                        _in_context(fn))
+        except Exception as e:
+            return e, None
+
+    try:
+        async with entry[0]:
+            # Every call finishes before the session's turn ends
+            outcomes = await asyncio.gather(*map(run, calls))
+    finally:
+        _leave(session_id, entry, len(calls))
+    for error, _ in outcomes:
+        if error is not None:
+            raise error
+    return [result for _, result in outcomes]
+
+
+def _admit(session_id, jobs):
+    """Count `jobs` new jobs, or raise Overloaded if there is no room."""
+    global _pending
+    if _pending + jobs > MAX_PENDING_JOBS:
+        raise Overloaded('Server is busy, please retry in a moment.')
+
+    entry = None
+    if session_id is not None:
+        entry = _session_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        if entry[1] >= MAX_SESSION_JOBS:
+            raise Overloaded(
+                'Too many queries running for this session, please wait.')
+        entry[1] += 1
+    _pending += jobs
+    return entry
+
+
+def _leave(session_id, entry, jobs):
+    global _pending
+    _pending -= jobs
+    if entry is not None:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _session_locks.pop(session_id, None)
+
+
+def _in_context(fn, *args, **kwargs):
+    # Carry the caller's context (e.g. the request being timed) along
+    return functools.partial(contextvars.copy_context().run,
+                             fn, *args, **kwargs)
+
+
+def pending_jobs() -> int:
+    """Jobs queued or running on the pool."""
+    return _pending
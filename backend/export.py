@@ -1,54 +1,230 @@
 import io
-import csv
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import (SimpleDocTemplate, Table,
+import math
+import os
+import tempfile
+from xml.sax.saxutils import escape
+import duckdb
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from reportlab.lib.pagesizes import letter, landscape
+from reportlab.platypus import (SimpleDocTemplate, LongTable,
                                 TableStyle, Paragraph, Spacer)
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
+from reportlab.graphics.shapes import Drawing
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+from reportlab.graphics.charts.linecharts import HorizontalLineChart
+from reportlab.graphics.charts.piecharts import Pie
 
 
-def export_csv(rows: list) -> bytes:
-    if not rows:
-        return b''
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=rows[0].keys())
-    writer.writeheader()
-    writer.writerows(rows)
-    return output.getvalue().encode()
+EXPORT_BATCH_ROWS = 64 * 1024
+# PDF reports list at most REPORT_MAX_ROWS rows, as tables of
+# REPORT_CHUNK_ROWS rows: one huge table is slow to lay out and is held in
+# memory whole, while each chunk is laid out and dropped on its own.
+REPORT_MAX_ROWS = int(os.getenv('REPORT_MAX_ROWS', 10_000))
+REPORT_CHUNK_ROWS = 500
+REPORT_CELL_CHARS = 40
+ACCENT = colors.HexColor('#4F46E5')
+PALETTE = [ACCENT] + [colors.HexColor(c) for c in (
+    '#06B6D4', '#10B981', '#F59E0B', '#EF4444', '#8B5CF6', '#EC4899',
+    '#84CC16', '#F97316', '#14B8A6', '#6366F1', '#A855F7', '#94A3B8')]
 
 
-def export_pdf(question, sql, summary, rows) -> bytes:
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
+def stream_csv(parquet_path: str):
+    """
+    Yield a stored result as CSV, one Arrow batch at a time, so memory use
+    does not depend on the number of rows.
+    """
+    con = duckdb.connect()
+    try:
+        reader = con.execute(
+            'SELECT * FROM read_parquet(?)', [parquet_path]
+        ).fetch_record_batch(EXPORT_BATCH_ROWS)
+        header = True
+        for batch in reader:
+            buffer = io.BytesIO()
+            pa_csv.write_csv(batch, buffer,
+                             pa_csv.WriteOptions(include_header=header))
+            header = False
+            yield buffer.getvalue()
+        if header:
+            buffer = io.BytesIO()
+            pa_csv.write_csv(reader.schema.empty_table(), buffer)
+            yield buffer.getvalue()
+    finally:
+        con.close()
+
+
+def copy_csv_gz(parquet_path: str) -> str:
+    """
+    Write a stored result to a gzip-compressed CSV temp file with DuckDB's
+    COPY and return its path. The caller deletes the file.
+    """
+    fd, path = tempfile.mkstemp(suffix='.csv.gz')
+    os.close(fd)
+    con = duckdb.connect()
+    try:
+        source = parquet_path.replace("'", "''")
+        con.execute(
+            f"COPY (SELECT * FROM read_parquet('{source}')) TO '{path}' "
+            "(FORMAT csv, HEADER, COMPRESSION gzip)")
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        con.close()
+    return path
+
+
+def render_report(target: str, question: str, sql: str, summary: str,
+                  parquet_path: str = None, rows: list = (),
+                  chart: dict = None, chart_type: str = None):
+    """
+    Write a PDF report to `target`: the question, SQL and summary, the
+    chart (a charts.chart_data series) and the result, read from the stored
+    result at `parquet_path` or else from the row dicts in `rows`. Runs in
+    a report worker process (see reports.py).
+    """
+    tmp = f'{target}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            if parquet_path:
+                parquet = pq.ParquetFile(parquet_path, memory_map=True)
+                _build_pdf(f, question, sql, summary, _parquet_chunks(parquet),
+                           parquet.metadata.num_rows, chart, chart_type)
+            else:
+                _build_pdf(f, question, sql, summary, _row_chunks(rows),
+                           len(rows), chart, chart_type)
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _row_chunks(rows):
+    """(header, chunks of rows) for row dicts."""
+    rows = list(rows)[:REPORT_MAX_ROWS]
+    header = list(rows[0].keys()) if rows else []
+    chunks = ([[r.get(c) for c in header]
+               for r in rows[i:i + REPORT_CHUNK_ROWS]]
+              for i in range(0, len(rows), REPORT_CHUNK_ROWS))
+    return header, chunks
+
+
+def _parquet_chunks(parquet):
+    """(header, chunks of rows) read from a Parquet file batch by batch."""
+    def chunks():
+        left = REPORT_MAX_ROWS
+        for batch in parquet.iter_batches(batch_size=REPORT_CHUNK_ROWS):
+            if left <= 0:
+                return
+            batch = batch.slice(0, left)
+            left -= batch.num_rows
+            yield [list(row) for row in zip(
+                *(column.to_pylist() for column in batch.columns))]
+    return parquet.schema_arrow.names, chunks()
+
+
+def _build_pdf(out, question, sql, summary, table, total,
+               chart=None, chart_type=None):
+    header, chunks = table
+    pagesize = landscape(letter) if len(header) > 8 else letter
+    doc = SimpleDocTemplate(out, pagesize=pagesize)
     styles = getSampleStyleSheet()
     story = []
 
     story.append(Paragraph('QueryMind Report', styles['Title']))
     story.append(Spacer(1, 12))
-    story.append(Paragraph(f'<b>Question:</b> {question}',
+    story.append(Paragraph(f'<b>Question:</b> {escape(question)}',
                            styles['Normal']))
     story.append(Spacer(1, 6))
-    story.append(Paragraph(f'<b>SQL:</b> {sql}',
+    story.append(Paragraph(f'<b>SQL:</b> {escape(sql)}',
                            styles['Code']))
     story.append(Spacer(1, 6))
-    story.append(Paragraph(f'<b>Insight:</b> {summary}',
+    story.append(Paragraph(f'<b>Insight:</b> {escape(summary)}',
                            styles['Normal']))
     story.append(Spacer(1, 12))
 
-    if rows:
-        cols = list(rows[0].keys())
-        data = [cols] + [[str(r.get(c, '')) for c in cols]
-                         for r in rows[:50]]
-        t = Table(data)
-        t.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4F46E5')),
+    drawing = _chart_drawing(chart, chart_type, doc.width) if chart else None
+    if drawing is not None:
+        story.append(drawing)
+        story.append(Spacer(1, 12))
+
+    if header:
+        shown = min(total, REPORT_MAX_ROWS)
+        note = (f'{total:,} rows' if shown == total
+                else f'First {shown:,} of {total:,} rows')
+        story.append(Paragraph(note, styles['Italic']))
+        story.append(Spacer(1, 6))
+        widths = [doc.width / len(header)] * len(header)
+        style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), ACCENT),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            ('FONTSIZE', (0, 0), (-1, -1), 8),
+            ('FONTSIZE', (0, 0), (-1, -1), 7),
             ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
             ('ROWBACKGROUNDS', (0, 1), (-1, -1),
              [colors.white, colors.HexColor('#EEF2FF')]),
-        ]))
-        story.append(t)
+        ])
+        # The header repeats at the top of every chunk and every page
+        for chunk in chunks:
+            data = [header] + [[_cell(v) for v in row] for row in chunk]
+            t = LongTable(data, colWidths=widths, repeatRows=1)
+            t.setStyle(style)
+            story.append(t)
 
     doc.build(story)
-    return buffer.getvalue()
+
+
+def _cell(value) -> str:
+    text = '' if value is None else str(value)
+    if len(text) > REPORT_CELL_CHARS:
+        text = text[:REPORT_CELL_CHARS - 1] + '…'
+    return text
+
+
+def _chart_drawing(chart, chart_type, width):
+    """A ReportLab drawing of a chart series, or None if there is no data."""
+    # NULL and NaN values (None once in the series) are left out
+    xs, ys = chart['data'][0], chart['data'][1]
+    points = [(x, float(y)) for x, y in zip(xs, ys)
+              if y is not None and math.isfinite(float(y))]
+    if not points:
+        return None
+    labels = [_cell(x)[:16] for x, _ in points]
+    values = [y for _, y in points]
+    drawing = Drawing(width, 240)
+    if chart_type == 'pie':
+        values = [max(v, 0.0) for v in values]
+        if not sum(values):
+            return None
+        plot = Pie()
+        plot.x, plot.y = width / 2 - 90, 30
+        plot.width = plot.height = 180
+        plot.data, plot.labels = values, labels
+        plot.slices.strokeColor = colors.white
+        plot.slices.fontSize = 7
+        for i in range(len(values)):
+            plot.slices[i].fillColor = PALETTE[i % len(PALETTE)]
+    else:
+        if chart_type == 'line':
+            plot = HorizontalLineChart()
+            plot.data = [values]
+            plot.lines[0].strokeColor = ACCENT
+            # Label about a dozen points, evenly spaced
+            every = max(1, len(labels) // 12)
+            labels = [label if i % every == 0 else ''
+                      for i, label in enumerate(labels)]
+        else:
+            plot = VerticalBarChart()
+            plot.data = [values]
+            plot.bars[0].fillColor = ACCENT
+        plot.x, plot.y = 40, 50
+        plot.width, plot.height = width - 50, 170
+        plot.categoryAxis.categoryNames = labels
+        plot.categoryAxis.labels.angle = 30
+        plot.categoryAxis.labels.boxAnchor = 'ne'
+        plot.categoryAxis.labels.fontSize = 7
+        plot.valueAxis.labels.fontSize = 7
+        plot.valueAxis.forceZero = True
+    drawing.add(plot)
+    return drawing
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+import duckdb
+
+# Limits for model-generated SQL. Memory and thread caps are applied to
+# every session connection (see sessions.py); these bound a single query.
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', 30))
+MAX_ESTIMATED_ROWS = int(float(os.getenv('MAX_ESTIMATED_ROWS', 5e8)))
+
+_lock = threading.Lock()
+_running = {}      # query_id -> {'con', 'stopped'}
+_cancelled = {}    # query_id -> None, cancelled (refused if run again)
+_MAX_CANCELLED = 1000
+
+
+@contextmanager
+def governed(con, query_id: str = None):
+    """
+    Run the body as query `query_id` on `con`: interrupt it after
+    QUERY_TIMEOUT seconds or when cancel(query_id) is called.
+    """
+    query_id = query_id or uuid.uuid4().hex
+    state = {'con': con, 'stopped': None}
+    with _lock:
+        if query_id in _cancelled:
+            raise ValueError('Query cancelled.')
+        _running[query_id] = state
+    timer = threading.Timer(QUERY_TIMEOUT, _stop, (query_id, 'timeout'))
+    timer.daemon = True
+    timer.start()
+    try:
+        yield query_id
+    except Exception:
+        if state['stopped'] == 'timeout':
+            raise ValueError(
+                f'Query stopped after {QUERY_TIMEOUT:g}s. '
+                'Try a narrower question.')
+        if state['stopped'] == 'cancelled':
+            raise ValueError('Query cancelled.')
+        raise
+    finally:
+        timer.cancel()
+        with _lock:
+            _running.pop(query_id, None)
+
+
+def cancel(query_id: str) -> bool:
+    """
+    Stop a running query. Every later run with the same id is refused too,
+    so a query queued behind the one stopped (such as the exact run after
+    an approximate preview) does not start. Returns whether a query was
+    running.
+    """
+    with _lock:
+        if len(_cancelled) >= _MAX_CANCELLED:
+            _cancelled.pop(next(iter(_cancelled)))
+        _cancelled[query_id] = None
+    return _stop(query_id, 'cancelled')
+
+
+def _stop(query_id, reason) -> bool:
+    with _lock:
+        state = _running.get(query_id)
+        if state is None or state['stopped']:
+            return False
+        state['stopped'] = reason
+        state['con'].interrupt()
+    return True
+
+
+def check_cost(con, sql: str):
+    """
+    Reject the query unless it is exactly one SELECT statement, or if
+    DuckDB's plan estimates more than MAX_ESTIMATED_ROWS rows at any
+    operator (e.g. an accidental cross join). The statement is checked
+    before EXPLAIN, which would run anything after a ';'.
+    """
+    try:
+        statements = con.extract_statements(sql)
+    except duckdb.ParserException:
+        return  # execution reports the syntax error
+    if len(statements) != 1 \
+            or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError('Query rejected: only a single SELECT query '
+                         'can be run.')
+    try:
+        plan = con.execute(f'EXPLAIN (FORMAT json) {sql}').fetchone()[1]
+        tree = json.loads(plan)
+    except Exception:
+        # Older DuckDB without JSON plans, or a statement EXPLAIN can't
+        # describe: let execution report any real error.
+        return
+    estimate = max((_estimate(node)[1] for node in tree), default=0)
+    if estimate > MAX_ESTIMATED_ROWS:
+        raise ValueError(
+            f'Query rejected: it would produce about {estimate:,} '
+            'intermediate rows. Check the joins or add filters.')
+
+
+def _estimate(node):
+    """
+    (estimated output rows of `node`, largest estimate anywhere below it).
+    Cross products carry no estimate of their own; they multiply their
+    inputs.
+    """
+    children = [_estimate(c) for c in node.get('children', [])]
+    extra = node.get('extra_info') or {}
+    own = str(extra.get('Estimated Cardinality', '')).replace(',', '')
+    if own.isdigit():
+        rows = int(own)
+    elif node.get('name') == 'CROSS_PRODUCT' and children:
+        rows = 1
+        for output, _ in children:
+            rows *= max(output, 1)
+    else:
+        rows = max((output for output, _ in children), default=0)
+    return rows, max([rows] + [peak for _, peak in children])
@@ -1,19 +1,136 @@
-from groq import Groq
+from groq import AsyncGroq
+import asyncio
 import json
 import os
+import re
 from dotenv import load_dotenv
+from metrics import span, inc
 
 load_dotenv()
 
-client = Groq(api_key=os.getenv('GROQ_API_KEY'))
+client = AsyncGroq(api_key=os.getenv('GROQ_API_KEY'))
 
+# Upper bound on concurrent Groq requests from this process
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 16))
+_llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
 
-def build_system_prompt(schema, sample, row_count):
+
+async def _complete(call, **kwargs):
+    with span(f'llm_{call}'):
+        async with _llm_slots:
+            resp = await client.chat.completions.create(**kwargs)
+    _count_tokens(call, resp.usage)
+    return resp.choices[0].message.content
+
+
+async def _stream(call, **kwargs):
+    """Yield the completion's text as it arrives."""
+    with span(f'llm_{call}'):
+        async with _llm_slots:
+            stream = await client.chat.completions.create(stream=True,
+                                                          **kwargs)
+            async for chunk in stream:
+                usage = chunk.usage or getattr(chunk.x_groq, 'usage', None)
+                if usage is not None:  # sent with the last chunk
+                    _count_tokens(call, usage)
+                delta = (chunk.choices[0].delta.content
+                         if chunk.choices else None)
+                if delta:
+                    yield delta
+
+
+def _count_tokens(call, usage):
+    if usage is None:
+        return
+    inc('querymind_llm_tokens_total', usage.prompt_tokens,
+        call=call, kind='prompt')
+    inc('querymind_llm_tokens_total', usage.completion_tokens,
+        call=call, kind='completion')
+
+
+def _parse_json(raw):
+    raw = raw.replace('```json', '').replace('```', '').strip()
+    return json.loads(raw)
+
+
+# The "sql" field of a (possibly incomplete) nl_to_sql response
+_SQL_FIELD = re.compile(r'"sql"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+# Rough size of the column descriptions in a prompt, in tokens
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 1500))
+
+
+def _tokens(text):
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _words(text):
+    words = set(re.findall(r'[a-z0-9]+', text.lower()))
+    return words | {w[:-1] for w in words if len(w) > 3 and w.endswith('s')}
+
+
+def _relevance(column, question):
+    """How strongly the question refers to this column (0 = not at all)."""
+    q = question.lower()
+    name = column['name'].lower()
+    score = 10 if name in q else 0
+    score += 3 * len(_words(name) & _words(q))
+    for value in column.get('top') or []:
+        if len(value) > 2 and value.lower() in q:
+            score += 5
+    return score
+
+
+def _column_line(column):
+    parts = [f'- "{column["name"]}" {column["type"]}']
+    if column.get('min') is not None:
+        parts.append(f'{column["min"]} .. {column["max"]}')
+    parts.append(f'~{column["distinct"]} distinct')
+    if column.get('null_rate'):
+        parts.append(f'{column["null_rate"]:.0%} null')
+    if column.get('top'):
+        parts.append('e.g. ' + ', '.join(repr(v) for v in column['top']))
+    return ' | '.join(parts)
+
+
+def describe_columns(profile, question='', budget=PROMPT_TOKEN_BUDGET):
+    """
+    Describe the columns most relevant to the question in detail, then name
+    the others, staying within `budget` tokens.
+    """
+    order = sorted(range(len(profile)),
+                   key=lambda i: -_relevance(profile[i], question))
+    detailed, used = set(), 0
+    for i in order:
+        cost = _tokens(_column_line(profile[i]))
+        if used + cost > budget:
+            break
+        detailed.add(i)
+        used += cost
+
+    lines = [_column_line(c) for i, c in enumerate(profile) if i in detailed]
+    others = [c['name'] for i, c in enumerate(profile) if i not in detailed]
+    if others:
+        names = []
+        for name in others:
+            used += _tokens(name) + 1
+            if used > budget * 1.25:
+                break
+            names.append(f'"{name}"')
+        rest = len(others) - len(names)
+        lines.append('Other columns: ' + ', '.join(names)
+                     + (f' and {rest} more' if rest else ''))
+    return '\n'.join(lines)
+
+
+def build_system_prompt(profile, row_count, question=''):
     return f"""You are a DuckDB SQL analyst.
 The user uploaded a CSV as a table called 'data'.
 
-Schema: {json.dumps(schema, indent=2)}
-Sample (first 3 rows): {json.dumps(sample, indent=2)}
+Columns (name, type, range, distinct values, nulls, common values):
+{describe_columns(profile, question)}
 Total rows: {row_count}
 
 Respond ONLY with this JSON and nothing else — no extra text, no markdown backticks:
@@ -42,47 +159,127 @@ Rules:
 - Example for month query: SELECT MONTHNAME("Order Date") AS month, SUM("Sales") AS total_sales FROM data GROUP BY month ORDER BY total_sales DESC"""
 
 
-def nl_to_sql(question, schema, sample, row_count):
-    resp = client.chat.completions.create(
+def _sql_request(question, profile, row_count):
+    return dict(
         model="llama-3.3-70b-versatile",
         messages=[
             {"role": "system", "content": build_system_prompt(
-                schema, sample, row_count)},
+                profile, row_count, question)},
             {"role": "user", "content": question}
         ],
         temperature=0
     )
-    raw = resp.choices[0].message.content
-    raw = raw.replace('```json', '').replace('```', '').strip()
-    return json.loads(raw)
 
 
-def summarize(question, sql, rows):
-    resp = client.chat.completions.create(
+def _summary_request(question, sql, rows):
+    return dict(
         model="llama-3.3-70b-versatile",
         messages=[{"role": "user", "content":
                    f"Question: {question}\nSQL: {sql}\n"
-                   f"Results: {json.dumps(rows[:20])}\n"
+                   f"Results: {json.dumps(rows[:20], default=str)}\n"
                    "Write 2-3 sentence plain-English business insight. Be specific with numbers."
                    }]
     )
-    return resp.choices[0].message.content
 
 
-def suggest_initial(schema, sample):
-    resp = client.chat.completions.create(
+async def nl_to_sql(question, profile, row_count):
+    raw = await _complete('sql',
+                          **_sql_request(question, profile, row_count))
+    return _parse_json(raw)
+
+
+async def stream_nl_to_sql(question, profile, row_count):
+    """
+    Like nl_to_sql, but yields ('sql', sql) as soon as the model has finished
+    writing the SQL, then ('parsed', full response) at the end.
+    """
+    raw, sql_sent = '', False
+    async for delta in _stream(
+            'sql', **_sql_request(question, profile, row_count)):
+        raw += delta
+        if not sql_sent:
+            match = _SQL_FIELD.search(raw)
+            if match:
+                sql_sent = True
+                yield 'sql', json.loads(f'"{match.group(1)}"')
+    yield 'parsed', _parse_json(raw)
+
+
+async def summarize(question, sql, rows):
+    return await _complete('summary',
+                           **_summary_request(question, sql, rows))
+
+
+async def nl_to_sql_batch(questions, profile, row_count):
+    """
+    nl_to_sql for several questions about the same data in one request, so
+    the column descriptions are sent once. If the combined answer doesn't
+    parse, each question is asked on its own; the list then holds the
+    exception for any that failed.
+    """
+    request = _sql_request(' '.join(questions), profile, row_count)
+    numbered = '\n'.join(f'{i}. {q}' for i, q in enumerate(questions, 1))
+    request['messages'][-1] = {"role": "user", "content":
+                               f"Answer each of these questions:\n{numbered}\n"
+                               "Respond ONLY with a JSON array holding one object in the format above per question, in the same order."
+                               }
+    try:
+        parsed = _parse_json(await _complete('sql_batch', **request))
+        if isinstance(parsed, list) and len(parsed) == len(questions) \
+                and all(isinstance(p, dict) and p.get('sql') for p in parsed):
+            return parsed
+    except ValueError:
+        pass
+    return await asyncio.gather(
+        *(nl_to_sql(q, profile, row_count) for q in questions),
+        return_exceptions=True)
+
+
+async def summarize_batch(items):
+    """
+    summarize for several (question, sql, rows) at once, in one request
+    when the model's answer parses, else one request each.
+    """
+    parts = [f"{i}. Question: {question}\nSQL: {sql}\n"
+             f"Results: {json.dumps(rows[:10], default=str)}"
+             for i, (question, sql, rows) in enumerate(items, 1)]
+    try:
+        parsed = _parse_json(await _complete(
+            'summary_batch',
+            model="llama-3.3-70b-versatile",
+            messages=[{"role": "user", "content":
+                       "\n\n".join(parts) + "\n\n"
+                       "For each numbered result, write a 2-3 sentence plain-English business insight. Be specific with numbers. "
+                       "Respond ONLY with a JSON array of strings, one per result, in the same order."
+                       }]
+        ))
+        if isinstance(parsed, list) and len(parsed) == len(items):
+            return [str(p) for p in parsed]
+    except ValueError:
+        pass
+    return await asyncio.gather(*(summarize(*item) for item in items),
+                                return_exceptions=True)
+
+
+async def stream_summary(question, sql, rows):
+    """Yield the summary text as the model writes it."""
+    async for delta in _stream(
+            'summary', **_summary_request(question, sql, rows)):
+        yield delta
+
+
+async def suggest_initial(profile):
+    raw = await _complete(
+        'suggest',
         model="llama-3.3-70b-versatile",
         messages=[{"role": "user", "content":
-                   f"Schema: {json.dumps(schema)}\n"
-                   f"Sample: {json.dumps(sample[:2])}\n"
+                   f"Columns:\n{describe_columns(profile)}\n"
                    "Return ONLY a JSON array of 6 strings. Each string is a question a business user would ask about this data. "
                    "Example format: [\"What is the total revenue?\", \"Which category sells most?\"] "
                    "No markdown, no extra text, no objects, just a flat JSON array of 6 strings."
                    }]
     )
-    raw = resp.choices[0].message.content
-    raw = raw.replace('```json', '').replace('```', '').strip()
-    result = json.loads(raw)
+    result = _parse_json(raw)
     # Make absolutely sure it's a flat list of strings
     flat = []
     for item in result:
@@ -1,13 +1,36 @@
-from export import export_csv, export_pdf
-from llm import nl_to_sql, summarize, suggest_initial
-from csv_handler import load_csv, run_query
-from db import init_db, save_query, get_history
-from fastapi import FastAPI, UploadFile, HTTPException
+from export import stream_csv, copy_csv_gz
+from llm import (nl_to_sql, summarize, suggest_initial,
+                 stream_nl_to_sql, stream_summary,
+                 nl_to_sql_batch, summarize_batch)
+from csv_handler import (load_csv, append_csv, session_meta, to_records,
+                         INGEST_PROGRESS)
+from cursors import (open_cursor, open_cursors, fetch_page, cursor_path,
+                     cursor_info)
+from approx import run_sample
+from charts import chart_data
+from prefetch import (schedule, claim, forget,
+                      stats as prefetch_stats)
+from db import init_db, save_query, get_history, ran_query
+from executor import run_db, pending_jobs, Overloaded
+from metrics import RequestMetrics, gauge, render, span, note
+from sessions import SESSIONS
+from governor import cancel
+from cache import get_answer, put_answer, stats as cache_stats
+from results import stats as result_cache_stats
+from reports import (report_id, start as start_report, status as report_status,
+                     wait as wait_report, stats as report_stats)
+from fastapi import FastAPI, Request, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import (JSONResponse, Response, StreamingResponse,
+                               FileResponse)
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import asyncio
+import contextvars
+import json
 import os
+import uuid
 
 load_dotenv()  # reads your .env file
 
@@ -15,69 +38,505 @@ load_dotenv()  # reads your .env file
 app = FastAPI()
 app.add_middleware(CORSMiddleware,
                    allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+app.add_middleware(RequestMetrics)
 init_db()
 
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    return JSONResponse({'detail': str(exc)}, status_code=503,
+                        headers={'Retry-After': '1'})
+
+
+@app.exception_handler(ValueError)
+async def rejected(request: Request, exc: ValueError):
+    # Bad uploads, failed or stopped queries and expired results: the
+    # message is written for the user
+    return JSONResponse({'detail': str(exc)}, status_code=400)
+
 # ── Upload CSV ───────────────────────────────────────────────────
 
 
 @app.post('/upload')
-async def upload(file: UploadFile):
-    contents = await file.read()
-    result = load_csv(contents, file.filename)
-    suggestions = suggest_initial(result['schema'], result['sample'])
+async def upload(file: UploadFile, upload_id: str | None = None):
+    result = await run_db(None, load_csv, file.file, file.filename,
+                          upload_id=upload_id, total_bytes=file.size)
+    suggestions = await suggest_initial(result['profile'])
+    schedule(result['session_id'], suggestions, result)
     return {**result, 'suggestions': suggestions}
 
+
+@app.post('/upload/{session_id}/append')
+async def append(session_id: str, file: UploadFile,
+                 upload_id: str | None = None):
+    forget(session_id)  # prefetched answers describe the old data
+    return await run_db(session_id, append_csv, session_id, file.file,
+                        file.filename, upload_id=upload_id,
+                        total_bytes=file.size)
+
+
+@app.get('/upload/{upload_id}/progress')
+def upload_progress(upload_id: str):
+    progress = INGEST_PROGRESS.get(upload_id)
+    if progress is None:
+        raise HTTPException(404, 'No upload in progress with this id')
+    return progress
+
 # ── Run a query ───────────────────────────────────────────────────
 
 
 class QueryRequest(BaseModel):
     session_id: str
     question:   str
-    schema:     list
-    sample:     list
-    row_count:  int
+    query_id:   str | None = None  # lets the client cancel the run
+    approximate: bool = False      # answer from a sample on large data
+    explain:    bool = False       # return DuckDB's profile of the run
+
+
+_refining = set()  # exact runs behind approximate /query answers
 
 
 @app.post('/query')
 async def query(req: QueryRequest):
-    parsed = nl_to_sql(req.question, req.schema,
-                       req.sample, req.row_count)
-    rows = run_query(req.session_id, parsed['sql'])
-    summary = summarize(req.question, parsed['sql'], rows)
+    with span('session_meta'):
+        meta = await run_db(req.session_id, session_meta, req.session_id)
+    fingerprint = meta['fingerprint']
+    with span('answer_cache'):
+        warm = await claim(req.session_id, req.question)
+        cached = warm or await asyncio.to_thread(get_answer, fingerprint,
+                                                 req.question)
+    note(answer_cache='warm' if warm else 'hit' if cached else 'miss')
+    if cached:
+        parsed = cached['parsed']
+    else:
+        parsed = await nl_to_sql(req.question, meta['profile'],
+                                 meta['row_count'])
+    result = warm['result'] if warm else None
+    if result is None and req.approximate:
+        result = await run_db(req.session_id, run_sample, req.session_id,
+                              parsed['sql'], meta['row_count'], req.query_id)
+    if result is None:
+        result = await run_db(req.session_id, open_cursor, req.session_id,
+                              parsed['sql'], query_id=req.query_id,
+                              explain=req.explain)
+    note(rows=result['total_rows'])
+    chart = await _chart(req.session_id, result, parsed)
+    if cached:
+        summary = cached['summary']
+    else:
+        summary = await summarize(req.question, parsed['sql'],
+                                  to_records(result, 20))
+    if 'approximate' in result:
+        # A preview: the exact run behind it is what gets remembered
+        task = asyncio.create_task(
+            _refine(req, fingerprint, parsed, cached),
+            context=contextvars.Context())
+        _refining.add(task)
+        task.add_done_callback(_refining.discard)
+    else:
+        if not cached:
+            await asyncio.to_thread(put_answer, fingerprint, req.question,
+                                    {'parsed': parsed, 'summary': summary})
+        with span('save_query'):
+            save_query(req.session_id, req.question, parsed['sql'],
+                       summary, result['total_rows'], parsed['chart_type'])
+    schedule(req.session_id, parsed.get('suggested_followups', []), meta)
+    return {**parsed, **result, 'chart': chart, 'summary': summary}
+
+
+async def _refine(req, fingerprint, parsed, cached):
+    """
+    Run the exact query behind an approximate /query answer and record it
+    as /query/stream does: history gets the exact row count, and the answer
+    cache a summary of the exact rows.
+    """
+    try:
+        result = await run_db(req.session_id, open_cursor, req.session_id,
+                              parsed['sql'], query_id=req.query_id)
+        if cached:
+            summary = cached['summary']
+        else:
+            summary = await summarize(req.question, parsed['sql'],
+                                      to_records(result, 20))
+            await asyncio.to_thread(put_answer, fingerprint, req.question,
+                                    {'parsed': parsed, 'summary': summary})
+    except Exception:
+        return  # cancelled or failed: nothing exact to remember
     save_query(req.session_id, req.question, parsed['sql'],
-               summary, len(rows), parsed['chart_type'])
-    return {**parsed, 'rows': rows[:500],
-            'total_rows': len(rows), 'summary': summary}
+               summary, result['total_rows'], parsed['chart_type'])
+
+
+async def _chart(session_id, result, parsed):
+    """The chart series for a stored result (previews have none)."""
+    if 'cursor_id' not in result:
+        return None
+    with span('chart'):
+        return await run_db(session_id, chart_data, session_id,
+                            result['cursor_id'], parsed.get('chart_type'),
+                            parsed.get('x_key'), parsed.get('y_key'))
+
+
+@app.post('/query/stream')
+async def query_stream(req: QueryRequest):
+    """
+    Same as /query, but streams newline-delimited JSON events as each stage
+    finishes: started, sql, meta, rows, chart, summary (one per token),
+    done or error. The SQL starts running as soon as the model has written
+    it, and is cancelled if the client goes away. With `approximate`, a
+    preview event answered from a sample comes before the exact rows.
+    """
+    return StreamingResponse(_query_events(req),
+                             media_type='application/x-ndjson')
+
+
+def _event(kind, **data):
+    return json.dumps({'type': kind, **data}, default=str) + '\n'
+
+
+async def _query_events(req: QueryRequest):
+    query_id = req.query_id or uuid.uuid4().hex
+    preview, run = None, None
+
+    def start(sql):
+        # Queued in this order on the session, so the preview runs first
+        nonlocal preview, run
+        if req.approximate:
+            preview = asyncio.create_task(run_db(
+                req.session_id, run_sample, req.session_id, sql,
+                meta['row_count'], query_id))
+        run = asyncio.create_task(run_db(
+            req.session_id, open_cursor, req.session_id, sql,
+            query_id=query_id, explain=req.explain))
+
+    try:
+        yield _event('started', query_id=query_id)
+        with span('session_meta'):
+            meta = await run_db(req.session_id, session_meta,
+                                req.session_id)
+        fingerprint = meta['fingerprint']
+        with span('answer_cache'):
+            warm = await claim(req.session_id, req.question)
+            cached = warm or await asyncio.to_thread(get_answer, fingerprint,
+                                                     req.question)
+        note(answer_cache='warm' if warm else 'hit' if cached else 'miss')
+        if cached:
+            parsed = cached['parsed']
+            yield _event('sql', sql=parsed['sql'])
+        else:
+            async for kind, value in stream_nl_to_sql(
+                    req.question, meta['profile'], meta['row_count']):
+                if kind == 'sql':
+                    yield _event('sql', sql=value)
+                    start(value)
+                else:
+                    parsed = value
+        yield _event('meta', **parsed)
+
+        if warm:
+            result = warm['result']
+        else:
+            if run is None:
+                start(parsed['sql'])
+            if preview is not None:
+                try:
+                    approximate = await preview
+                except Exception:
+                    approximate = None  # the exact run reports real errors
+                if approximate is not None:
+                    yield _event('preview', **approximate)
+            with span('query_wait'):
+                result = await run
+        note(rows=result['total_rows'])
+        yield _event('rows', **result)
+        chart = await _chart(req.session_id, result, parsed)
+        if chart is not None:
+            yield _event('chart', **chart)
+
+        if cached:
+            summary = cached['summary']
+            yield _event('summary', text=summary)
+        else:
+            summary = ''
+            async for token in stream_summary(req.question, parsed['sql'],
+                                              to_records(result, 20)):
+                summary += token
+                yield _event('summary', text=token)
+        yield _event('done', summary=summary)
+    except Exception as e:
+        yield _event('error', detail=str(e))
+        return
+    finally:
+        # Client disconnected or a later stage failed: stop the database
+        # work too, not just the task waiting on it.
+        if run is not None and not run.done():
+            cancel(query_id)
+            run.cancel()
+        if preview is not None and not preview.done():
+            preview.cancel()
+
+    with span('save_query'):
+        save_query(req.session_id, req.question, parsed['sql'],
+                   summary, result['total_rows'], parsed['chart_type'])
+    if not cached:
+        await asyncio.to_thread(put_answer, fingerprint, req.question,
+                                {'parsed': parsed, 'summary': summary})
+    schedule(req.session_id, parsed.get('suggested_followups', []), meta)
+
+
+class CancelRequest(BaseModel):
+    query_id: str
+
+
+@app.post('/query/cancel')
+def query_cancel(req: CancelRequest):
+    return {'cancelled': cancel(req.query_id)}
+
+# ── Dashboard (several questions at once) ───────────────────────
+
+DASHBOARD_MAX_QUESTIONS = int(os.getenv('DASHBOARD_MAX_QUESTIONS', 20))
+
+
+class DashboardRequest(BaseModel):
+    session_id: str
+    questions:  list[str]
+    query_id:   str | None = None  # widget i is cancelled as f'{id}-{i}'
+
+
+@app.post('/dashboard')
+async def dashboard(req: DashboardRequest):
+    """
+    Answer several questions about one session together. The SQL for all
+    of them comes from one LLM request, the queries run concurrently with
+    identical ones run once, and the summaries come from one request too.
+    A widget that fails carries an 'error' instead of failing the others.
+    """
+    questions = [q for q in req.questions if q.strip()]
+    if not questions or len(questions) > DASHBOARD_MAX_QUESTIONS:
+        raise HTTPException(
+            400, f'Send between 1 and {DASHBOARD_MAX_QUESTIONS} questions')
+    with span('session_meta'):
+        meta = await run_db(req.session_id, session_meta, req.session_id)
+    fingerprint = meta['fingerprint']
+    with span('answer_cache'):
+        cached = await asyncio.to_thread(
+            lambda: [get_answer(fingerprint, q) for q in questions])
+
+    missing = [q for q, c in zip(questions, cached) if not c]
+    generated = iter(await nl_to_sql_batch(missing, meta['profile'],
+                                           meta['row_count'])
+                     if missing else [])
+    parsed = [c['parsed'] if c else next(generated) for c in cached]
+
+    runnable = [i for i, p in enumerate(parsed) if isinstance(p, dict)]
+    outcomes = dict(zip(runnable, await open_cursors(
+        req.session_id, [parsed[i]['sql'] for i in runnable],
+        query_id=req.query_id)))
+
+    widgets = []
+    for i, question in enumerate(questions):
+        outcome = outcomes.get(i, parsed[i])
+        if isinstance(outcome, Exception):
+            widgets.append({'question': question, 'error': str(outcome)})
+            continue
+        chart = await _chart(req.session_id, outcome, parsed[i])
+        widgets.append({'question': question, **parsed[i], **outcome,
+                        'chart': chart})
+
+    fresh = [w for w, c in zip(widgets, cached) if 'error' not in w and not c]
+    summaries = iter(await summarize_batch(
+        [(w['question'], w['sql'], to_records(w, 20)) for w in fresh])
+        if fresh else [])
+    for widget, answer, hit in zip(widgets, parsed, cached):
+        if 'error' in widget:
+            continue
+        if hit:
+            widget['summary'] = hit['summary']
+        else:
+            summary = next(summaries)
+            widget['summary'] = summary if isinstance(summary, str) else ''
+            if widget['summary']:
+                await asyncio.to_thread(put_answer, fingerprint,
+                                        widget['question'],
+                                        {'parsed': answer,
+                                         'summary': widget['summary']})
+        save_query(req.session_id, widget['question'], widget['sql'],
+                   widget['summary'], widget['total_rows'],
+                   widget.get('chart_type'))
+    note(widgets=len(widgets))
+    return {'widgets': widgets}
+
+# ── Page through a stored result ─────────────────────────────────
+
+
+class PageRequest(BaseModel):
+    session_id: str
+    cursor_id:  str
+    offset:     int = 0
+    limit:      int = 100
+    sort_by:    str | None = None
+    descending: bool = False
+    filters:    list = []
+
+
+@app.post('/cursor/page')
+async def cursor_page(req: PageRequest):
+    return await run_db(req.session_id, fetch_page, req.session_id,
+                        req.cursor_id, req.offset, req.limit, req.sort_by,
+                        req.descending, req.filters)
+
+
+@app.get('/cache/stats')
+def answer_cache_stats():
+    return {**cache_stats(), 'prefetch': prefetch_stats(),
+            'results': result_cache_stats(), 'reports': report_stats()}
+
+# ── Metrics ───────────────────────────────────────────────────────
+
+
+def _by_stat(stats):
+    return {(('stat', k),): v for k, v in stats.items()
+            if isinstance(v, (int, float))}
+
+
+gauge('querymind_open_sessions', lambda: SESSIONS.stats()['open_sessions'])
+gauge('querymind_session_memory_bytes',
+      lambda: SESSIONS.stats()['memory_bytes'])
+gauge('querymind_pending_jobs', pending_jobs)
+gauge('querymind_answer_cache', lambda: _by_stat(cache_stats()))
+gauge('querymind_prefetch', lambda: _by_stat(prefetch_stats()))
+gauge('querymind_result_cache', lambda: _by_stat(result_cache_stats()))
+gauge('querymind_reports', lambda: _by_stat(report_stats()))
+
+
+@app.get('/metrics')
+def metrics():
+    """Stage timings, token counts and gauges for Prometheus."""
+    return Response(render(), media_type='text/plain; version=0.0.4')
 
 # ── Query history ─────────────────────────────────────────────────
 
 
 @app.get('/history/{session_id}')
-def history(session_id: str):
-    return get_history(session_id)
+def history(session_id: str, limit: int = 20, before_id: int | None = None):
+    return get_history(session_id, min(max(limit, 1), 100), before_id)
 
 # ── Export ────────────────────────────────────────────────────────
 
 
 class ExportRequest(BaseModel):
-    format:   str
-    question: str
-    sql:      str
-    summary:  str
-    rows:     list
+    format:     str
+    question:   str
+    sql:        str
+    summary:    str
+    session_id: str | None = None
+    cursor_id:  str | None = None
+    rows:       list = []
+    chart_type: str | None = None  # PDF only: the chart to draw
+    x_key:      str | None = None
+    y_key:      str | None = None
 
 
 @app.post('/export')
-def export(req: ExportRequest):
+async def export(req: ExportRequest):
+    if req.format == 'pdf':
+        # Kept for old clients: waits for the report (see /reports)
+        with span('export_pdf'):
+            path = await wait_report(
+                (await _start_report(req))['report_id'])
+        return FileResponse(path, media_type='application/pdf',
+                            filename='report.pdf')
+    if req.format not in ('csv', 'csv.gz', 'parquet'):
+        raise HTTPException(400, 'Invalid format')
+    if not req.session_id:
+        raise HTTPException(400, 'session_id is required')
+
+    path = await _stored_result(req.session_id, req.cursor_id, req.sql)
+    filename = f'results.{req.format}'
+    headers = {'Content-Disposition': f'attachment; filename={filename}'}
     if req.format == 'csv':
-        data = export_csv(req.rows)
-        return Response(data, media_type='text/csv',
-                        headers={'Content-Disposition':
-                                 'attachment; filename=results.csv'})
-    elif req.format == 'pdf':
-        data = export_pdf(req.question, req.sql,
-                          req.summary, req.rows)
-        return Response(data, media_type='application/pdf',
-                        headers={'Content-Disposition':
-                                 'attachment; filename=report.pdf'})
-    raise HTTPException(400, 'Invalid format')
+        return StreamingResponse(stream_csv(path), media_type='text/csv',
+                                 headers=headers)
+    if req.format == 'parquet':
+        return FileResponse(path, media_type='application/vnd.apache.parquet',
+                            filename=filename)
+    with span('export_csv_gz'):
+        tmp = await run_db(None, copy_csv_gz, path)
+    return FileResponse(tmp, media_type='application/gzip', filename=filename,
+                        background=BackgroundTask(os.remove, tmp))
+
+
+async def _stored_result(session_id, cursor_id, sql) -> str:
+    """
+    The stored result's file. If it has expired, the query is run again,
+    but only when the session's history has that exact SQL: SQL sent by
+    the client is never run as given.
+    """
+    path = cursor_path(session_id, cursor_id)
+    if path is None:
+        if not await asyncio.to_thread(ran_query, session_id, sql):
+            raise HTTPException(404,
+                                'Result expired. Please run the query again.')
+        with span('export_rerun'):
+            cursor = await run_db(session_id, open_cursor, session_id, sql, 0)
+        path = cursor_path(session_id, cursor['cursor_id'])
+    return path
+
+# ── PDF reports ───────────────────────────────────────────────────
+# POST /reports starts rendering a report in the background and returns its
+# id; poll GET /reports/{id} until 'done', then download GET /reports/{id}/pdf.
+# Reports of stored results cover the whole result, not just the rows shown.
+
+
+@app.post('/reports')
+async def create_report(req: ExportRequest):
+    return await _start_report(req)
+
+
+@app.get('/reports/{rid}')
+def get_report(rid: str):
+    status = report_status(rid)
+    if status is None:
+        raise HTTPException(404, 'Unknown report')
+    return status
+
+
+@app.get('/reports/{rid}/pdf')
+async def download_report(rid: str):
+    status = report_status(rid)
+    if status is None:
+        raise HTTPException(404, 'Unknown report')
+    if status['status'] != 'done':
+        raise HTTPException(409, f"Report is {status['status']}")
+    return FileResponse(await wait_report(rid), media_type='application/pdf',
+                        filename='report.pdf')
+
+
+async def _start_report(req: ExportRequest) -> dict:
+    """
+    Start (or find) the report for a request. For a session the table is
+    the stored result and the SQL shown is the one that produced it, read
+    from the cursor, never the request body's.
+    """
+    fingerprint, path, sql = None, None, req.sql
+    if req.session_id:
+        with span('session_meta'):
+            meta = await run_db(req.session_id, session_meta, req.session_id)
+        fingerprint = meta['fingerprint']
+        path = await _stored_result(req.session_id, req.cursor_id, req.sql)
+        sql = cursor_info(path).get('sql', sql)
+    chart_spec = [req.chart_type, req.x_key, req.y_key]
+    rid = report_id(fingerprint, sql, req.question, req.summary,
+                    chart_spec, req.rows)
+    status = report_status(rid)
+    if status and status['status'] != 'failed':
+        note(report='cached' if status['status'] == 'done' else 'running')
+        return status
+
+    text = {'question': req.question, 'sql': sql, 'summary': req.summary}
+    if path is None:
+        return start_report(rid, rows=req.rows, **text)
+    cursor_id = os.path.basename(path)[:-len('.parquet')]
+    parsed = dict(zip(('chart_type', 'x_key', 'y_key'), chart_spec))
+    chart = await _chart(req.session_id, {'cursor_id': cursor_id}, parsed)
+    return start_report(rid, parquet_path=path, chart=chart,
+                        chart_type=req.chart_type, **text)
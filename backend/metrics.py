@@ -0,0 +1,221 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Timings, counters and gauges for every stage of upload, query and export,
+# exposed in the Prometheus text format by /metrics, plus one structured
+# JSON log line per request listing its stages.
+LOG_REQUESTS = os.getenv('LOG_REQUESTS', '1') == '1'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+log = logging.getLogger('querymind.requests')
+if LOG_REQUESTS and not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(_handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # name -> callable returning {labels: value} or a value
+_help = {}
+
+# The request being served, so stages run in worker threads are attributed
+# to it (run_db copies the context into the pool)
+_request = contextvars.ContextVar('request', default=None)
+
+
+def describe(name: str, text: str):
+    _help[name] = text
+
+
+def observe(name: str, seconds: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        if bucket < len(BUCKETS):  # slower ones only count towards +Inf
+            entry[bucket] += 1
+        entry[-2] += seconds
+        entry[-1] += 1
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    record = _request.get()
+    if record is not None and name == 'querymind_llm_tokens_total':
+        tokens = record.setdefault('tokens', {})
+        tokens[labels['kind']] = tokens.get(labels['kind'], 0) + value
+
+
+def gauge(name: str, read):
+    """
+    Register a callable read at scrape time. It returns a number, or a
+    {((label, value), ...): number} dict.
+    """
+    _gauges[name] = read
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage: querymind_stage_seconds{stage} and the request log."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('querymind_stage_seconds', elapsed, stage=stage)
+        record = _request.get()
+        if record is not None:
+            record['stages'].append(
+                {'stage': stage, 'ms': round(elapsed * 1000, 2)})
+
+
+def note(**fields):
+    """Attach fields (row counts, cache hits...) to the request log."""
+    record = _request.get()
+    if record is not None:
+        record.update(fields)
+
+
+@contextmanager
+def capture_profile(con, into: dict):
+    """
+    Profile the statements run on `con` in the block with DuckDB's JSON
+    profiler (the EXPLAIN ANALYZE data) and store the tree in into['plan'].
+    """
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    con.execute("SET enable_profiling = 'json'")
+    con.execute("SET profiling_output = '{}'".format(
+        path.replace("'", "''")))
+    try:
+        yield
+    finally:
+        con.execute('RESET enable_profiling')
+        con.execute('RESET profiling_output')
+        try:
+            with open(path) as f:
+                into['plan'] = json.load(f)
+        except (OSError, ValueError):
+            into['plan'] = None
+        os.remove(path)
+
+
+class RequestMetrics:
+    """
+    ASGI middleware: request latency by route and status, and one JSON log
+    line per request once its (possibly streamed) body has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        record = {'method': scope['method'], 'path': scope['path'],
+                  'stages': []}
+        token = _request.set(record)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                record['status'] = message['status']
+            await send(message)
+            if (message['type'] == 'http.response.body'
+                    and not message.get('more_body')):
+                _finish(scope, record, start)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            record['status'] = 500
+            _finish(scope, record, start)
+            raise
+        finally:
+            _request.reset(token)
+
+
+def _finish(scope, record, start):
+    if record.get('done'):
+        return
+    record['done'] = True
+    elapsed = time.perf_counter() - start
+    route = getattr(scope.get('route'), 'path', 'unmatched')
+    observe('querymind_request_seconds', elapsed, route=route,
+            method=record['method'], status=str(record.get('status', 0)))
+    if LOG_REQUESTS:
+        record.pop('done')
+        log.info(json.dumps({**record, 'route': route,
+                             'ms': round(elapsed * 1000, 2)}, default=str))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines, seen = [], set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f'# HELP {name} {_help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    with _lock:
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+        counters = sorted(_counters.items())
+    for (name, labels), entry in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(BUCKETS, entry):
+            cumulative += n
+            lines.append(f'{name}_bucket{_labels(labels, le=bound)} '
+                         f'{cumulative}')
+        lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} '
+                     f'{entry[-1]}')
+        lines.append(f'{name}_sum{_labels(labels)} {entry[-2]}')
+        lines.append(f'{name}_count{_labels(labels)} {entry[-1]}')
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append(f'{name}{_labels(labels)} {value}')
+    for name, read in sorted(_gauges.items()):
+        try:
+            value = read()
+        except Exception:
+            continue
+        header(name, 'gauge')
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f'{name}{_labels(labels)} {v}')
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    body = ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+    return '{' + body + '}'
+
+
+describe('querymind_stage_seconds', 'Time spent in each processing stage.')
+describe('querymind_request_seconds', 'HTTP request latency, body included.')
+describe('querymind_llm_tokens_total', 'LLM tokens used, by call and kind.')
+describe('querymind_sql_retries_total',
+         'Queries re-run with TRY_CAST date fixes after failing.')
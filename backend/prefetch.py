@@ -0,0 +1,196 @@
+import asyncio
+import contextvars
+import os
+import time
+import uuid
+from cache import get_answer, put_answer, normalize_question
+from csv_handler import to_records
+from cursors import open_cursor, cursor_path
+from executor import run_db, pending_jobs
+from governor import cancel
+from llm import nl_to_sql, summarize
+
+# Suggested questions are answered in the background while the user reads,
+# so clicking one is instant. Prefetching only uses the database when no
+# other job is queued, runs at most PREFETCH_CONCURRENCY questions at once
+# across all sessions, and a session's prefetch stops as soon as the user
+# asks something. A question the user asks while it is being prefetched is
+# taken over: from then on it waits for neither a slot nor an idle database.
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '1') == '1'
+PREFETCH_MAX_QUESTIONS = int(os.getenv('PREFETCH_MAX_QUESTIONS', 6))
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', 2))
+PREFETCH_TTL = int(os.getenv('PREFETCH_TTL', 900))
+PREFETCH_MAX_WARM = 1000
+IDLE_POLL = 0.2
+
+_slots = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+_warm = {}      # (session_id, question key) -> (expires, answer)
+_sessions = {}  # session_id -> {'task', 'current': (key, task, query_id,
+                #                           claimed event)}
+_stats = {'scheduled': 0, 'warmed': 0, 'hits': 0, 'joined': 0,
+          'cancelled': 0}
+
+
+def schedule(session_id: str, questions: list, meta: dict):
+    """
+    Start answering `questions` for the session in the background,
+    replacing anything still pending for it.
+    """
+    stop(session_id)
+    questions = [q for q in questions if isinstance(q, str) and q.strip()]
+    if not PREFETCH_ENABLED or not questions:
+        return
+    state = {'current': None}
+    # A fresh context: background work is not part of the request's log
+    state['task'] = asyncio.create_task(
+        _run(session_id, questions[:PREFETCH_MAX_QUESTIONS], meta, state),
+        context=contextvars.Context())
+    _sessions[session_id] = state
+    _stats['scheduled'] += len(questions[:PREFETCH_MAX_QUESTIONS])
+
+
+async def claim(session_id: str, question: str):
+    """
+    The prefetched answer to `question` ({'parsed', 'result', 'summary'}),
+    waiting for it if it is being computed right now, or None. Any other
+    prefetch work for the session is stopped either way: the user is here.
+    """
+    key = normalize_question(question)
+    answer = _take(session_id, key)
+    state = _sessions.get(session_id)
+    if answer is None and state and state['current'] \
+            and state['current'][0] == key:
+        _, current, _, claimed = state['current']
+        claimed.set()  # the user is waiting: no more background priority
+        state['current'] = None  # keep it running; stop the rest
+        stop(session_id)
+        try:
+            answer = await current
+            _stats['joined'] += 1
+        except Exception:
+            answer = None
+    else:
+        stop(session_id)
+        if answer is not None:
+            _stats['hits'] += 1
+    if answer is not None and cursor_path(
+            session_id, answer['result']['cursor_id']) is None:
+        return None
+    return answer
+
+
+def stop(session_id: str):
+    """Cancel a session's pending prefetch, including a running query."""
+    state = _sessions.pop(session_id, None)
+    if state is None:
+        return
+    state['task'].cancel()
+    if state['current'] is not None:
+        _, task, query_id, _ = state['current']
+        task.cancel()
+        cancel(query_id)
+        _stats['cancelled'] += 1
+
+
+def forget(session_id: str):
+    """Stop prefetching for a session and drop its warm answers."""
+    stop(session_id)
+    for key in [k for k in _warm if k[0] == session_id]:
+        del _warm[key]
+
+
+def stats() -> dict:
+    return {**_stats, 'warm': len(_warm), 'active_sessions': len(_sessions)}
+
+
+async def _run(session_id, questions, meta, state):
+    try:
+        for question in questions:
+            key = normalize_question(question)
+            if (session_id, key) in _warm:
+                continue
+            query_id = f'prefetch-{uuid.uuid4().hex}'
+            claimed = asyncio.Event()
+            task = asyncio.create_task(
+                _answer(session_id, question, meta, query_id, claimed))
+            state['current'] = (key, task, query_id, claimed)
+            try:
+                # Shielded so that a claim can take over this question
+                # while the rest of the list is cancelled
+                answer = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                continue
+            finally:
+                state['current'] = None
+            _store(session_id, key, answer)
+    finally:
+        if _sessions.get(session_id) is state:
+            del _sessions[session_id]
+
+
+async def _answer(session_id, question, meta, query_id, claimed):
+    slot = await _take_slot(claimed)
+    try:
+        cached = await asyncio.to_thread(get_answer, meta['fingerprint'],
+                                         question)
+        if cached:
+            parsed = cached['parsed']
+        else:
+            parsed = await nl_to_sql(question, meta['profile'],
+                                     meta['row_count'])
+        while pending_jobs() and not claimed.is_set():
+            await _pause(claimed)  # user queries go first
+        result = await run_db(session_id, open_cursor, session_id,
+                              parsed['sql'], query_id=query_id)
+        if cached:
+            summary = cached['summary']
+        else:
+            summary = await summarize(question, parsed['sql'],
+                                      to_records(result, 20))
+            await asyncio.to_thread(put_answer, meta['fingerprint'],
+                                    question,
+                                    {'parsed': parsed, 'summary': summary})
+    finally:
+        if slot:
+            _slots.release()
+    _stats['warmed'] += 1
+    return {'parsed': parsed, 'result': result, 'summary': summary}
+
+
+async def _take_slot(claimed) -> bool:
+    """
+    Wait for one of the PREFETCH_CONCURRENCY slots, unless the question is
+    claimed first. Returns whether a slot was taken.
+    """
+    while _slots.locked() and not claimed.is_set():
+        await _pause(claimed)
+    if claimed.is_set():
+        return False
+    await _slots.acquire()  # free, so this does not wait
+    return True
+
+
+async def _pause(claimed):
+    """Sleep IDLE_POLL, or less if the question is claimed meanwhile."""
+    try:
+        await asyncio.wait_for(claimed.wait(), IDLE_POLL)
+    except asyncio.TimeoutError:
+        pass
+
+
+def _store(session_id, key, answer):
+    now = time.time()
+    for k in [k for k, (expires, _) in _warm.items() if expires < now]:
+        del _warm[k]
+    while len(_warm) >= PREFETCH_MAX_WARM:
+        del _warm[next(iter(_warm))]
+    _warm[(session_id, key)] = (now + PREFETCH_TTL, answer)
+
+
+def _take(session_id, key):
+    entry = _warm.pop((session_id, key), None)
+    if entry is None or entry[0] < time.time():
+        return None
+    return entry[1]
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from export import render_report
+from results import canonical_sql
+
+# PDF reports are rendered in worker processes, so a large one neither
+# blocks the event loop nor takes a query thread, and the workers run at a
+# lower priority than the server. A finished report is kept under a hash of
+# what it shows (data version, SQL, text, chart), so asking for it again is
+# answered from the file. The most recently used REPORT_MAX_FILES are kept.
+REPORT_DIR = os.getenv('REPORT_DIR', 'reports')
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', 2))
+REPORT_MAX_FILES = int(os.getenv('REPORT_MAX_FILES', 200))
+REPORT_NICE = 10
+
+_pool = None
+_jobs = {}  # report id -> future of its render, while running or failed
+
+
+def report_id(fingerprint, sql, question, summary, chart_spec, rows=None):
+    """
+    Id of the report for a query result. Reports of stored results are
+    identified by the dataset version; reports of client rows by the rows.
+    """
+    text = json.dumps([fingerprint, canonical_sql(sql), question, summary,
+                       chart_spec, None if fingerprint else rows],
+                      default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def report_file(rid: str) -> str:
+    if not re.fullmatch(r'[0-9a-f]{64}', rid or ''):
+        raise ValueError('Unknown report')
+    return os.path.join(REPORT_DIR, f'{rid}.pdf')
+
+
+def status(rid: str):
+    """{'report_id', 'status': running|done|failed[, 'error']}, or None."""
+    try:
+        path = report_file(rid)
+    except ValueError:
+        return None
+    if os.path.exists(path):
+        return {'report_id': rid, 'status': 'done'}
+    job = _jobs.get(rid)
+    if job is None:
+        return None
+    if not job.done():
+        return {'report_id': rid, 'status': 'running'}
+    error = job.exception()
+    if error is None:  # finished but since deleted
+        return None
+    return {'report_id': rid, 'status': 'failed', 'error': str(error)}
+
+
+def start(rid: str, parquet_path: str = None, **render) -> dict:
+    """
+    Render report `rid` in the worker pool unless it is done or running;
+    `render` are render_report's arguments. The stored result is linked
+    first, so the cursor expiring mid-render doesn't matter. Returns the
+    report's status.
+    """
+    current = status(rid)
+    if current and current['status'] != 'failed':
+        return current
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    snapshot = None
+    if parquet_path:
+        snapshot = os.path.join(REPORT_DIR,
+                                f'.{rid}.{uuid.uuid4().hex}.parquet')
+        try:
+            os.link(parquet_path, snapshot)
+        except OSError:
+            shutil.copyfile(parquet_path, snapshot)
+    job = asyncio.get_running_loop().run_in_executor(
+        _get_pool(), _render, report_file(rid), snapshot, render)
+    _jobs[rid] = job
+    job.add_done_callback(lambda f: _finished(rid, snapshot, f))
+    return {'report_id': rid, 'status': 'running'}
+
+
+async def wait(rid: str) -> str:
+    """The report's file once it has been rendered."""
+    job = _jobs.get(rid)
+    if job is not None:
+        await asyncio.shield(job)
+    path = report_file(rid)
+    if not os.path.exists(path):
+        raise ValueError('Report expired. Please export it again.')
+    os.utime(path)  # expiry counts from the last download
+    return path
+
+
+def stats() -> dict:
+    running = sum(1 for job in _jobs.values() if not job.done())
+    files = 0
+    if os.path.isdir(REPORT_DIR):
+        files = sum(1 for name in os.listdir(REPORT_DIR)
+                    if name.endswith('.pdf'))
+    return {'running': running, 'files': files}
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked: the server has DuckDB and event
+        # loop threads that a fork would copy mid-flight
+        _pool = ProcessPoolExecutor(
+            REPORT_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_lower_priority)
+    return _pool
+
+
+def _lower_priority():
+    if hasattr(os, 'nice'):
+        os.nice(REPORT_NICE)
+
+
+def _render(target, parquet_path, render):
+    render_report(target, parquet_path=parquet_path, **render)
+
+
+def _finished(rid, snapshot, job):
+    global _pool
+    if snapshot and os.path.exists(snapshot):
+        os.remove(snapshot)
+    if job.cancelled():
+        _jobs.pop(rid, None)
+        return
+    if isinstance(job.exception(), BrokenProcessPool):
+        _pool = None  # a worker died; start a new pool for the next report
+    if job.exception() is None:
+        _jobs.pop(rid, None)
+        _expire()
+
+
+def _expire():
+    """Delete the least recently used reports beyond REPORT_MAX_FILES."""
+    reports = []
+    for name in os.listdir(REPORT_DIR):
+        if not name.endswith('.pdf'):
+            continue
+        path = os.path.join(REPORT_DIR, name)
+        try:
+            reports.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue
+    for _, path in sorted(reports, reverse=True)[REPORT_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
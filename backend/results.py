@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+
+# Query results already computed for a dataset version. Different questions
+# often compile to the same SQL, and history items are re-run, so a cursor's
+# Parquet file is kept here under the dataset fingerprint and the cleaned-up
+# SQL. Appending rows changes the fingerprint, which retires old entries.
+# Least recently used entries are deleted beyond the size budget.
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'results')
+RESULT_CACHE_BYTES = int(os.getenv('RESULT_CACHE_MB', 2048)) * 1024 * 1024
+
+# Functions whose result changes from one run to the next
+_VOLATILE = re.compile(
+    r'\b(random|uuid|gen_random_uuid|setseed|now|today|current_date|'
+    r'current_time|current_timestamp|get_current_timestamp|sample|'
+    r'tablesample)\b', re.IGNORECASE)
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evictions': 0}
+
+
+def canonical_sql(sql: str) -> str:
+    """
+    The SQL with comments dropped and whitespace collapsed outside quotes,
+    so formatting differences don't defeat the cache.
+    """
+    out, i, quote = [], 0, None
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            out.append(ch)
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+            out.append(ch)
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = len(sql) if end < 0 else end
+            continue
+        elif ch.isspace():
+            if out and out[-1] != ' ':
+                out.append(' ')
+        else:
+            out.append(ch)
+        i += 1
+    return ''.join(out).strip().rstrip(';').strip()
+
+
+def result_key(fingerprint: str, sql: str):
+    """Cache key for `sql` on a dataset version, or None if uncacheable."""
+    if not fingerprint or _VOLATILE.search(sql):
+        return None
+    text = f'{fingerprint}\n{canonical_sql(sql)}'
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _entry(key: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, f'{key}.parquet')
+
+
+def lookup(key: str, target: str):
+    """
+    Place the cached result for `key` at `target` and return its sidecar
+    ({'sql', 'total_rows'}), or None on a miss.
+    """
+    if key is None:
+        return None
+    path = _entry(key)
+    try:
+        with open(path[:-len('.parquet')] + '.json') as f:
+            info = json.load(f)
+        _place(path, target)
+        os.utime(path)  # eviction counts from the last use
+    except (OSError, ValueError):
+        _stats['misses'] += 1
+        return None
+    _stats['hits'] += 1
+    return info
+
+
+def store(key: str, source: str, info: dict):
+    """Keep the result file `source` (and `info`) as the entry for `key`."""
+    if key is None:
+        return
+    try:
+        size = os.path.getsize(source)
+    except OSError:
+        return
+    if size > RESULT_CACHE_BYTES:
+        return
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    path = _entry(key)
+    tmp = os.path.join(RESULT_CACHE_DIR, f'.{key}.{uuid.uuid4().hex}')
+    try:
+        with open(tmp + '.json', 'w') as f:
+            json.dump(info, f)
+        _place(source, tmp + '.parquet')
+        # Sidecar first: a lookup that finds it also finds the data
+        os.replace(tmp + '.json', path[:-len('.parquet')] + '.json')
+        os.replace(tmp + '.parquet', path)
+    except OSError:
+        return
+    finally:
+        for p in (tmp + '.json', tmp + '.parquet'):
+            if os.path.exists(p):
+                os.remove(p)
+    _stats['stored'] += 1
+    _enforce_budget()
+
+
+def stats() -> dict:
+    entries, size = 0, 0
+    if os.path.isdir(RESULT_CACHE_DIR):
+        for name in os.listdir(RESULT_CACHE_DIR):
+            if name.endswith('.parquet') and not name.startswith('.'):
+                entries += 1
+                try:
+                    size += os.path.getsize(
+                        os.path.join(RESULT_CACHE_DIR, name))
+                except OSError:
+                    pass
+    lookups = _stats['hits'] + _stats['misses']
+    return {**_stats, 'entries': entries, 'bytes': size,
+            'hit_rate': _stats['hits'] / lookups if lookups else 0.0}
+
+
+def _place(source: str, target: str):
+    """
+    Copy `source` to `target`. Not hard-linked: cursors and cache entries
+    each expire by their own mtime and count their own size.
+    """
+    shutil.copyfile(source, target)
+
+
+def _enforce_budget():
+    with _lock:
+        entries = []
+        for name in os.listdir(RESULT_CACHE_DIR):
+            if not name.endswith('.parquet') or name.startswith('.'):
+                continue
+            path = os.path.join(RESULT_CACHE_DIR, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):  # least recently used first
+            if total <= RESULT_CACHE_BYTES:
+                break
+            for p in (path, path[:-len('.parquet')] + '.json'):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+            _stats['evictions'] += 1
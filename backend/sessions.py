@@ -0,0 +1,247 @@
+import atexit
+import duckdb
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datasets import dataset_file
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+# A session is a directory holding meta.json (which dataset it reads, any
+# appended Parquet parts, schema and profile) and its cursors. The meta
+# files are the session registry: with SESSION_DIR and DATASET_DIR on a
+# shared volume, any worker or node can serve any session. Each process
+# opens its own in-memory DuckDB connection per session, with `data` as a
+# read-only view over the stored files, and keeps recently used ones open
+# up to a memory budget.
+SESSION_DIR = os.getenv('SESSION_DIR', 'sessions')
+SESSION_MEMORY_BUDGET = int(
+    os.getenv('SESSION_MEMORY_BUDGET_MB', 4096)) * 1024 * 1024
+
+# Per-connection DuckDB limits, so one runaway query spills to disk or fails
+# instead of taking the whole process down or starving other sessions.
+QUERY_MEMORY_LIMIT = os.getenv('QUERY_MEMORY_LIMIT', '1GB')
+QUERY_THREADS = int(os.getenv('QUERY_THREADS', 4))
+
+
+class SessionManager:
+    """
+    Keeps DuckDB connections for recently used sessions open and closes the
+    least recently used idle ones once their combined memory exceeds the
+    budget. Closed sessions are reopened from disk on their next use, and
+    open ones are rebuilt when another process changes their meta.json.
+    """
+
+    def __init__(self, directory: str, memory_budget: int):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self._open = OrderedDict()  # session_id -> connection, LRU first
+        self._versions = {}         # session_id -> meta.json mtime at open
+        self._memory = {}           # session_id -> bytes at last release
+        self._busy = {}             # session_id -> number of active users
+        self._fingerprints = {}     # session_id -> fingerprint of its view
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_id: str) -> str:
+        if not _is_session_id(session_id):
+            raise ValueError('Session expired. Please re-upload your file.')
+        return os.path.join(self.directory, session_id)
+
+    def _db_file(self, session_id: str) -> str:
+        # Sessions created before the dataset store kept their rows here
+        return os.path.join(self.path(session_id), 'data.duckdb')
+
+    def part_file(self, session_id: str, name: str) -> str:
+        return os.path.join(self.path(session_id), 'parts',
+                            os.path.basename(name))
+
+    def _meta_file(self, session_id: str) -> str:
+        return os.path.join(self.path(session_id), 'meta.json')
+
+    def meta(self, session_id: str) -> dict:
+        """Metadata stored next to the session database (schema, row count...)."""
+        if not _is_session_id(session_id):
+            return {}
+        try:
+            with open(self._meta_file(session_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def update_meta(self, session_id: str, **fields):
+        meta = {**self.meta(session_id), **fields}
+        tmp = f'{self._meta_file(session_id)}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp, self._meta_file(session_id))
+
+    @contextmanager
+    def locked(self, session_id: str):
+        """
+        Exclusive lock on the session across processes, for read-modify-
+        write changes such as appends.
+        """
+        with open(os.path.join(self.path(session_id), '.lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def create(self) -> str:
+        """Create an empty session directory and return its id."""
+        session_id = str(uuid.uuid4())
+        os.makedirs(self.path(session_id))
+        return session_id
+
+    def _version(self, session_id: str):
+        try:
+            return os.stat(self._meta_file(session_id)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _connect(self, session_id: str):
+        meta = self.meta(session_id)
+        sources = []
+        con = duckdb.connect()
+        try:
+            self.apply_limits(con)
+            if os.path.exists(self._db_file(session_id)):
+                path = self._db_file(session_id).replace("'", "''")
+                con.execute(f"ATTACH '{path}' AS stored (READ_ONLY)")
+                sources.append('SELECT * FROM stored.data')
+            files = [self.part_file(session_id, p)
+                     for p in meta.get('parts', [])]
+            if meta.get('dataset'):
+                files.insert(0, dataset_file(meta['dataset']))
+            if files:
+                paths = ', '.join("'{}'".format(
+                    os.path.abspath(f).replace("'", "''")) for f in files)
+                sources.append(f'SELECT * FROM read_parquet([{paths}])')
+            if not sources:
+                raise ValueError(
+                    'Session expired. Please re-upload your file.')
+            con.execute(
+                f"CREATE VIEW data AS {' UNION ALL '.join(sources)}")
+        except Exception:
+            con.close()
+            raise
+        self._fingerprints[session_id] = meta.get('fingerprint')
+        return con
+
+    def apply_limits(self, con):
+        """(Re)apply the per-query memory and thread limits to `con`."""
+        con.execute(f"SET memory_limit = '{QUERY_MEMORY_LIMIT}'")
+        con.execute(f'SET threads = {QUERY_THREADS}')
+
+    @contextmanager
+    def use(self, session_id: str):
+        """
+        Yield the session's connection, reopening it from disk if it was
+        evicted. The session cannot be evicted while it is in use.
+        """
+        version = self._version(session_id)
+        if version is None:
+            raise ValueError('Session expired. Please re-upload your file.')
+        with self._lock:
+            con = self._open.get(session_id)
+            if (con is not None and session_id not in self._busy
+                    and self._versions.get(session_id) != version):
+                self._evict(session_id)  # changed by another process
+                con = None
+            if con is None:
+                con = self._connect(session_id)
+                self._open[session_id] = con
+                self._versions[session_id] = version
+            self._open.move_to_end(session_id)
+            self._busy[session_id] = self._busy.get(session_id, 0) + 1
+        try:
+            yield con
+        finally:
+            memory = _memory_usage(con)
+            with self._lock:
+                self._busy[session_id] -= 1
+                if not self._busy[session_id]:
+                    del self._busy[session_id]
+                self._memory[session_id] = memory
+                self._enforce_budget()
+
+    def fingerprint(self, session_id: str):
+        """
+        Fingerprint of the data the session's open connection reads, which
+        may lag meta.json while another process is appending.
+        """
+        with self._lock:
+            return self._fingerprints.get(session_id)
+
+    def drop(self, session_id: str):
+        """Close a session and delete its files."""
+        with self._lock:
+            con = self._open.pop(session_id, None)
+            self._memory.pop(session_id, None)
+            self._versions.pop(session_id, None)
+            self._fingerprints.pop(session_id, None)
+        if con is not None:
+            con.close()
+        shutil.rmtree(self.path(session_id), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'open_sessions': len(self._open),
+                'memory_bytes':  sum(self._memory.get(s, 0)
+                                     for s in self._open),
+                'memory_budget': self.memory_budget,
+            }
+
+    def close_all(self):
+        with self._lock:
+            for session_id in list(self._open):
+                self._evict(session_id)
+
+    def _enforce_budget(self):
+        # Caller holds self._lock
+        total = sum(self._memory.get(s, 0) for s in self._open)
+        for session_id in list(self._open):
+            if total <= self.memory_budget:
+                break
+            if session_id in self._busy:
+                continue
+            total -= self._memory.get(session_id, 0)
+            self._evict(session_id)
+
+    def _evict(self, session_id: str):
+        # Caller holds self._lock. Connections only hold views over files
+        # on disk, so closing one loses nothing.
+        con = self._open.pop(session_id)
+        self._memory.pop(session_id, None)
+        self._versions.pop(session_id, None)
+        self._fingerprints.pop(session_id, None)
+        con.close()
+
+
+def _memory_usage(con) -> int:
+    try:
+        return con.execute(
+            'SELECT COALESCE(SUM(memory_usage_bytes), 0) FROM duckdb_memory()'
+        ).fetchone()[0]
+    except Exception:
+        return 0
+
+
+def _is_session_id(session_id: str) -> bool:
+    # Session ids become directory names, so only accept real uuids
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except ValueError:
+        return False
+
+
+SESSIONS = SessionManager(SESSION_DIR, SESSION_MEMORY_BUDGET)
+atexit.register(SESSIONS.close_all)
@@ -0,0 +1,118 @@
+import argparse
+import os
+import duckdb
+
+# Synthetic CSV uploads for the benchmarks. Every value is derived from the
+# row number with DuckDB's hash(), so a given shape, size and seed always
+# produces the same file, and 10M rows take seconds rather than minutes.
+SHAPES = ('narrow', 'wide')
+WIDE_METRICS = 40
+REGIONS = ['North', 'South', 'East', 'West', 'Central']
+PRODUCTS = [f'Product {i:03d}' for i in range(200)]
+
+
+def _h(k: int, seed: int) -> str:
+    """A deterministic pseudo-random UBIGINT for row i."""
+    return f'hash(i, {k * 1000 + seed})'
+
+
+def _pick(values: list, k: int, seed: int) -> str:
+    items = ', '.join("'{}'".format(v.replace("'", "''")) for v in values)
+    return f'([{items}])[1 + ({_h(k, seed)} % {len(values)})::INTEGER]'
+
+
+def _columns(shape: str, seed: int) -> list:
+    day = f"(DATE '2020-01-01' + ({_h(1, seed)} % 1826)::INTEGER)"
+    price = f"(({_h(2, seed)} % 1000000) / 100.0)"
+    columns = [
+        'i AS id',
+        # Mostly ISO dates, with some US and timestamp-formatted ones
+        f"""CASE {_h(3, seed)} % 100
+              WHEN 0 THEN strftime({day}, '%m/%d/%Y')
+              WHEN 1 THEN strftime({day}, '%Y-%m-%d %H:%M:%S')
+              ELSE strftime({day}, '%Y-%m-%d') END AS order_date""",
+        f"strftime({day} + 3, '%-m/%-d/%Y') AS ship_date",
+        f'{_pick(REGIONS, 4, seed)} AS region',
+        f'{_pick(PRODUCTS, 5, seed)} AS product',
+        f'1 + {_h(6, seed)} % 20 AS quantity',
+        # Dirty numerics: currency symbols, thousands separators, N/A, blanks
+        f"""CASE {_h(7, seed)} % 50
+              WHEN 0 THEN 'N/A'
+              WHEN 1 THEN ''
+              WHEN 2 THEN '$' || format('{{:,.2f}}', {price})
+              ELSE format('{{:.2f}}', {price}) END AS price""",
+        f"""CASE WHEN {_h(8, seed)} % 10 = 0 THEN NULL
+              ELSE ({_h(9, seed)} % 30) / 100.0 END AS discount""",
+        f"'order note ' || ({_h(10, seed)} % 100000) AS note",
+    ]
+    if shape == 'wide':
+        columns += [f"(({_h(100 + m, seed)} % 1000000) / 1000.0) "
+                    f'AS metric_{m:02d}' for m in range(WIDE_METRICS)]
+    return columns
+
+
+def generate_csv(path: str, rows: int, shape: str = 'narrow',
+                 seed: int = 0) -> str:
+    """Write a synthetic CSV to `path` (skipped if it already exists)."""
+    if shape not in SHAPES:
+        raise ValueError(f'Unknown shape: {shape}')
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.tmp'
+    con = duckdb.connect()
+    try:
+        select = ',\n'.join(_columns(shape, seed))
+        target = tmp.replace("'", "''")
+        con.execute(
+            f"COPY (SELECT {select} FROM range({int(rows)}) t(i) ORDER BY i) "
+            f"TO '{target}' (FORMAT csv, HEADER)")
+    finally:
+        con.close()
+    os.replace(tmp, path)
+    return path
+
+
+def write_parquet(csv_path: str) -> str:
+    """
+    Write the CSV's rows, typed as DuckDB reads them, to a Parquet file
+    next to it (skipped if it already exists) and return its path.
+    """
+    path = parquet_path(csv_path)
+    if os.path.exists(path):
+        return path
+    tmp = f'{path}.tmp'
+    con = duckdb.connect()
+    try:
+        con.execute(
+            "COPY (SELECT * FROM read_csv(?)) TO '{}' (FORMAT parquet)".format(
+                tmp.replace("'", "''")), [csv_path])
+    finally:
+        con.close()
+    os.replace(tmp, path)
+    return path
+
+
+def dataset_path(data_dir: str, rows: int, shape: str, seed: int) -> str:
+    return os.path.join(data_dir, f'{shape}-{rows}-{seed}.csv')
+
+
+def parquet_path(csv_path: str) -> str:
+    return csv_path[:-len('.csv')] + '.parquet'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic CSV for the benchmarks.')
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--shape', choices=SHAPES, default='narrow')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write the rows as typed Parquet')
+    args = parser.parse_args()
+    out = args.out or dataset_path(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'data'), args.rows, args.shape, args.seed)
+    print(generate_csv(out, args.rows, args.shape, args.seed))
+    if args.parquet:
+        print(write_parquet(out))
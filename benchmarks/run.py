@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# End-to-end benchmarks: upload, query, stream, page and export against the
+# real app (in process, over ASGI) with the LLM replaced by a local stub.
+# Results go to a JSON file that can be compared with a run on another
+# commit: python benchmarks/run.py --compare before.json
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(os.path.dirname(HERE), 'backend')
+sys.path.insert(0, HERE)
+
+from generate import dataset_path, parquet_path, SHAPES  # noqa: E402
+from stub_llm import StubGroq  # noqa: E402
+
+QUERIES = {
+    'How many orders are there?':
+        'SELECT COUNT(*) AS orders FROM data',
+    'What is the total quantity by region?':
+        'SELECT region, SUM(quantity) AS total_quantity FROM data '
+        'GROUP BY region ORDER BY total_quantity DESC',
+    'What is the revenue by product?':
+        'SELECT product, SUM(quantity * TRY_CAST(price AS DOUBLE)) AS revenue '
+        'FROM data GROUP BY product ORDER BY revenue DESC',
+    'How do orders trend by month?':
+        'SELECT YEAR(TRY_CAST(order_date AS TIMESTAMP)) AS year, '
+        'MONTH(TRY_CAST(order_date AS TIMESTAMP)) AS month, '
+        'COUNT(*) AS orders FROM data GROUP BY year, month ORDER BY year, month',
+    'What is the average discount by region and product?':
+        'SELECT region, product, AVG(discount) AS avg_discount FROM data '
+        'GROUP BY region, product ORDER BY region, product',
+    'Show the largest orders':
+        'SELECT * FROM data ORDER BY quantity DESC, id LIMIT 1000',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run the end-to-end benchmarks with a stub LLM.')
+    parser.add_argument('--rows', default='10000,100000',
+                        help='comma-separated dataset sizes')
+    parser.add_argument('--shapes', default='narrow,wide',
+                        help=f"comma-separated, from {', '.join(SHAPES)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each query and export workload')
+    parser.add_argument('--upload-repeat', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--llm-latency', type=float, default=0.0,
+                        help='seconds the stub LLM waits per call')
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'),
+                        help='where generated CSVs are kept between runs')
+    parser.add_argument('--out', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None,
+                        help='a previous --out file to compare against')
+    return parser.parse_args()
+
+
+def percentile(samples: list, p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+                 1)
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    async def run(self, dataset, workload, calls, concurrency=1):
+        """
+        Await the coroutine factories in `calls`, `concurrency` at a time,
+        and record their latencies.
+        """
+        samples, queue = [], list(calls)
+
+        async def worker():
+            while queue:
+                call = queue.pop(0)
+                start = time.perf_counter()
+                await call()
+                samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+        row = {
+            'dataset':     dataset,
+            'workload':    workload,
+            'ops':         len(samples),
+            'seconds':     round(wall, 4),
+            'ops_per_sec': round(len(samples) / wall, 2) if wall else None,
+            'p50_ms':      round(percentile(samples, 50) * 1000, 2),
+            'p99_ms':      round(percentile(samples, 99) * 1000, 2),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        self.results.append(row)
+        print(_format_row(row), flush=True)
+        return row
+
+
+async def _check(response):
+    if response.status_code >= 400:
+        await response.aread()
+        raise RuntimeError(f'{response.request.url.path} failed: '
+                           f'{response.status_code} {response.text[:200]}')
+    return response
+
+
+async def bench_dataset(client, recorder, name, path, args):
+    async def upload():
+        with open(path, 'rb') as f:
+            r = await _check(await client.post(
+                '/upload', files={'file': (os.path.basename(path), f)}))
+        return r.json()
+
+    async def upload_cold():
+        shutil.rmtree('datasets', ignore_errors=True)
+        await upload()
+
+    await recorder.run(name, 'upload', [upload_cold] * args.upload_repeat)
+    await recorder.run(name, 'upload_dedup',
+                       [upload] * args.upload_repeat)
+
+    async def upload_parquet_cold():
+        shutil.rmtree('datasets', ignore_errors=True)
+        parquet = parquet_path(path)
+        with open(parquet, 'rb') as f:
+            await _check(await client.post(
+                '/upload', files={'file': (os.path.basename(parquet), f)}))
+
+    await recorder.run(name, 'upload_parquet',
+                       [upload_parquet_cold] * args.upload_repeat)
+    session_id = (await upload())['session_id']
+
+    results = {}
+
+    def ask(question):
+        async def call():
+            r = await _check(await client.post('/query', json={
+                'session_id': session_id, 'question': question}))
+            results[question] = r.json()
+        return call
+
+    def ask_stream(question):
+        async def call():
+            async with client.stream('POST', '/query/stream', json={
+                    'session_id': session_id, 'question': question}) as r:
+                await _check(r)
+                async for line in r.aiter_lines():
+                    if line and json.loads(line)['type'] == 'error':
+                        raise RuntimeError(line)
+        return call
+
+    questions = list(QUERIES) * args.repeat
+    await recorder.run(name, 'query', [ask(q) for q in questions])
+    await recorder.run(name, 'query_stream',
+                       [ask_stream(q) for q in questions])
+
+    async def fresh_largest():
+        # The query phases open more cursors than a session keeps, so the
+        # result paged and exported is opened again right before (unrecorded)
+        await ask('Show the largest orders')()
+        return results['Show the largest orders']
+
+    largest = await fresh_largest()
+
+    async def page():
+        await _check(await client.post('/cursor/page', json={
+            'session_id': session_id, 'cursor_id': largest['cursor_id'],
+            'offset': 100, 'limit': 100, 'sort_by': 'product'}))
+
+    await recorder.run(name, 'page', [page] * args.repeat)
+
+    async def dashboard():
+        await _check(await client.post('/dashboard', json={
+            'session_id': session_id, 'questions': list(QUERIES)}))
+
+    await recorder.run(name, 'dashboard', [dashboard] * args.repeat)
+
+    def export(fmt):
+        async def call():
+            r = await _check(await client.post('/export', json={
+                'format': fmt, 'question': 'Show the largest orders',
+                'sql': largest['sql'], 'summary': largest['summary'],
+                'session_id': session_id, 'cursor_id': largest['cursor_id'],
+                'rows': _records(largest)}))
+            await r.aread()
+        return call
+
+    for fmt in ('csv', 'csv.gz', 'pdf'):
+        largest = await fresh_largest()
+        await recorder.run(name, f'export_{fmt}', [export(fmt)] * args.repeat)
+
+    # Several users at once, each in their own session on the same data
+    sessions = [(await upload())['session_id']
+                for _ in range(args.concurrency)]
+
+    def ask_in(sid, question):
+        async def call():
+            await _check(await client.post('/query', json={
+                'session_id': sid, 'question': question}))
+        return call
+
+    calls = [ask_in(sid, q) for q in QUERIES for sid in sessions]
+    await recorder.run(name, f'query_concurrent_{args.concurrency}',
+                       calls * args.repeat, concurrency=args.concurrency)
+
+
+def _records(result: dict) -> list:
+    names = [c['name'] for c in result['columns']]
+    return [dict(zip(names, row)) for row in zip(*result['data'])][:50]
+
+
+async def run_all(datasets, args) -> list:
+    import httpx
+    import main
+    recorder = Recorder()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                 timeout=None) as client:
+        for name, path in datasets:
+            await bench_dataset(client, recorder, name, path, args)
+    return recorder.results
+
+
+def _format_row(row: dict) -> str:
+    return (f"{row['dataset']:<18} {row['workload']:<22} {row['ops']:>5} "
+            f"{row['ops_per_sec'] or 0:>9.2f}/s p50 {row['p50_ms']:>9.2f}ms "
+            f"p99 {row['p99_ms']:>9.2f}ms rss {row['peak_rss_mb']:>7.1f}MB")
+
+
+def environment(args) -> dict:
+    def git(*cmd):
+        try:
+            return subprocess.run(['git', *cmd], cwd=HERE, text=True,
+                                  capture_output=True).stdout.strip()
+        except OSError:
+            return None
+
+    import duckdb
+    return {
+        'commit':   git('rev-parse', 'HEAD'),
+        'dirty':    bool(git('status', '--porcelain', '--', BACKEND)),
+        'python':   platform.python_version(),
+        'duckdb':   duckdb.__version__,
+        'platform': platform.platform(),
+        'cpus':     os.cpu_count(),
+        'args':     {k: v for k, v in vars(args).items()
+                     if k not in ('out', 'compare', 'data_dir')},
+    }
+
+
+def compare(results: list, baseline_file: str):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    before = {(r['dataset'], r['workload']): r for r in baseline['results']}
+    print(f"\nCompared with {baseline['environment'].get('commit')}:")
+    for row in results:
+        old = before.get((row['dataset'], row['workload']))
+        if old is None:
+            continue
+        print(f"{row['dataset']:<18} {row['workload']:<22} "
+              f"p50 {_ratio(row['p50_ms'], old['p50_ms'])} "
+              f"p99 {_ratio(row['p99_ms'], old['p99_ms'])} "
+              f"rss {_ratio(row['peak_rss_mb'], old['peak_rss_mb'])}")
+
+
+def _ratio(new, old) -> str:
+    if not old:
+        return '    n/a'
+    return f'{(new - old) / old:+7.1%}'
+
+
+def main():
+    args = parse_args()
+    out = os.path.abspath(args.out)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    datasets = []
+    for shape in args.shapes.split(','):
+        for rows in (int(n) for n in args.rows.split(',')):
+            path = dataset_path(args.data_dir, rows, shape, args.seed)
+            if not os.path.exists(parquet_path(path)):
+                # In a child process, so generating doesn't count towards
+                # the peak RSS measured here
+                subprocess.run([sys.executable,
+                                os.path.join(HERE, 'generate.py'),
+                                '--rows', str(rows), '--shape', shape,
+                                '--seed', str(args.seed), '--out', path,
+                                '--parquet'],
+                               check=True, stdout=subprocess.DEVNULL)
+            datasets.append((f'{shape}-{rows}', os.path.abspath(path)))
+
+    # A fresh working directory: sessions, datasets, history and caches
+    # all start empty, so runs don't depend on each other
+    workdir = tempfile.mkdtemp(prefix='querymind-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+    os.environ.setdefault('LOG_REQUESTS', '0')
+    os.environ.setdefault('PREFETCH_ENABLED', '0')
+    sys.path.insert(0, BACKEND)
+    import llm
+    llm.client = StubGroq(QUERIES, args.llm_latency)
+
+    try:
+        results = asyncio.run(run_all(datasets, args))
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(out, 'w') as f:
+        json.dump({'environment': environment(args), 'results': results},
+                  f, indent=2)
+    print(f'\nResults written to {out}')
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+
+# A local stand-in for the AsyncGroq client: same call shape, canned and
+# deterministic answers, token usage from the prompt size. An optional
+# delay imitates the model's latency without making results depend on a
+# network or on what the model happens to write.
+DEFAULT_SQL = 'SELECT COUNT(*) AS row_count FROM data'
+STREAM_CHUNK = 16
+SUMMARY = ('The results show a steady pattern across the groups, '
+           'with the largest group well ahead of the rest.')
+
+
+class StubGroq:
+    def __init__(self, queries: dict, latency: float = 0.0):
+        """`queries` maps each benchmark question to the SQL to answer."""
+        self.queries = queries
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model=None, messages=(), stream=False, **kw):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = self._answer(messages)
+        prompt = sum(len(m['content']) for m in messages)
+        usage = SimpleNamespace(prompt_tokens=prompt // 4 + 1,
+                                completion_tokens=len(content) // 4 + 1)
+        if stream:
+            return self._stream(content, usage)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                               usage=usage)
+
+    async def _stream(self, content, usage):
+        for i in range(0, len(content), STREAM_CHUNK):
+            delta = SimpleNamespace(content=content[i:i + STREAM_CHUNK])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)],
+                                  usage=None, x_groq=None)
+        yield SimpleNamespace(choices=[], usage=None,
+                              x_groq=SimpleNamespace(usage=usage))
+
+    def _answer(self, messages) -> str:
+        prompt = messages[-1]['content']
+        if messages[0]['role'] == 'system':
+            if prompt.startswith('Answer each of these questions'):
+                # One request for a whole dashboard
+                questions = re.findall(r'^\d+\. (.*)$', prompt, re.MULTILINE)
+                return json.dumps([self._sql(q) for q in questions])
+            return json.dumps(self._sql(prompt))
+        if 'For each numbered result' in prompt:
+            count = len(re.findall(r'^\d+\. Question:', prompt, re.MULTILINE))
+            return json.dumps([SUMMARY] * count)
+        if 'JSON array' in prompt:
+            return json.dumps(list(self.queries)[:6])
+        return SUMMARY
+
+    def _sql(self, question) -> dict:
+        return {
+            'sql':           self.queries.get(question, DEFAULT_SQL),
+            'explanation':   'Benchmark query.',
+            'chart_type':    'bar',
+            'x_key':         None,
+            'y_key':         None,
+            'chart_title':   question,
+            'suggested_followups': list(self.queries)[:3],
+        }
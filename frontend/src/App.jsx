@@ -3,9 +3,10 @@ import {
   BarChart, Bar, LineChart, Line, XAxis, YAxis,
   CartesianGrid, Tooltip, ResponsiveContainer, PieChart, Pie, Cell
 } from "recharts";
-import { uploadCSV, runQuery, getHistory, exportResults } from "./api";
+import { uploadCSV, appendCSV, runQueryStream, runDashboard, cancelQuery, fetchPage, getHistory, exportResults } from "./api";
 
 const CHART_COLORS = ["#6366f1","#f59e0b","#10b981","#ef4444","#8b5cf6","#06b6d4"];
+const UPLOAD_TYPES = ".csv,.tsv,.txt,.gz,.zst,.parquet,.json,.jsonl,.ndjson,.xlsx";
 
 function formatValue(v) {
   if (typeof v === "number") {
@@ -22,11 +23,14 @@ export default function App() {
   const [history, setHistoryList]     = useState([]);
   const [input, setInput]             = useState("");
   const [loading, setLoading]         = useState(false);
+  const [approximate, setApproximate] = useState(false);
   const [uploading, setUploading]     = useState(false);
   const [showHistory, setShowHistory] = useState(false);
   const bottomRef  = useRef(null);
   const inputRef   = useRef(null);
   const fileRef    = useRef(null);
+  const appendRef  = useRef(null);
+  const queryIdRef = useRef(null);
 
   useEffect(() => {
     bottomRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -58,6 +62,24 @@ export default function App() {
     setUploading(false);
   }
 
+  async function handleAppend(e) {
+    const file = e.target.files?.[0];
+    e.target.value = "";
+    if (!file || !session) return;
+    setUploading(true);
+    try {
+      const result = await appendCSV(session.session_id, file);
+      setSession(prev => ({ ...prev, row_count: result.row_count }));
+      setMessages(prev => [...prev, {
+        role: "assistant", type: "welcome",
+        text: `➕ Appended "${file.name}" — ${result.appended_rows.toLocaleString()} new rows, ${result.row_count.toLocaleString()} in total.`
+      }]);
+    } catch (err) {
+      setMessages(prev => [...prev, { role: "assistant", type: "error", text: "Append failed: " + err.message }]);
+    }
+    setUploading(false);
+  }
+
   // ── Fetch history ─────────────────────────────────────────────────────
   async function fetchHistory() {
     if (!session) return;
@@ -75,37 +97,102 @@ export default function App() {
     setLoading(true);
     setMessages(prev => [...prev, { role: "user", type: "user", text: q }]);
 
+    // The answer is filled in as the server streams each stage
+    const id = Date.now();
+    const update = patch => setMessages(prev =>
+      prev.map(m => m.id === id ? { ...m, ...patch(m) } : m));
+    setMessages(prev => [...prev, { id, role: "assistant", type: "result", question: q,
+                                    sql: "", summary: "", streaming: true }]);
+    let followups = [];
+    queryIdRef.current = crypto.randomUUID();
     try {
-      const result = await runQuery(
+      await runQueryStream(
         session.session_id, q,
-        session.schema, session.sample, session.row_count
+        event => {
+          if (event.type === "sql")     update(() => ({ sql: event.sql }));
+          if (event.type === "meta") {
+            followups = event.suggested_followups || [];
+            update(() => { const { type, ...meta } = event; return meta; });
+          }
+          if (event.type === "preview") update(() => { const { type, ...result } = event; return result; });
+          if (event.type === "rows")    update(() => { const { type, ...result } = event; return { ...result, approximate: null }; });
+          if (event.type === "chart")   update(() => ({ chart: event }));
+          if (event.type === "summary") update(m => ({ summary: m.summary + event.text }));
+          if (event.type === "done") {
+            update(() => ({ summary: event.summary, streaming: false }));
+          }
+        },
+        queryIdRef.current,
+        approximate
       );
-      setMessages(prev => [...prev, { role: "assistant", type: "result", question: q, ...result }]);
-      if (result.suggested_followups?.length) {
-        setSuggestions(result.suggested_followups);
-      }
+      if (followups.length) setSuggestions(followups);
       fetchHistory();
     } catch (err) {
-      setMessages(prev => [...prev, { role: "assistant", type: "error", text: err.message }]);
+      setMessages(prev => [...prev.filter(m => m.id !== id),
+                           { role: "assistant", type: "error", text: err.message }]);
     }
+    queryIdRef.current = null;
     setLoading(false);
     inputRef.current?.focus();
   }
 
+  // Answer all current suggestions in one request
+  async function handleAnswerAll() {
+    if (loading || !session || !suggestions.length) return;
+    const questions = suggestions;
+    setLoading(true);
+    setSuggestions([]);
+    try {
+      const widgets = await runDashboard(session.session_id, questions);
+      setMessages(prev => [...prev, ...widgets.flatMap(w => w.error
+        ? [{ role: "user", type: "user", text: w.question },
+           { role: "assistant", type: "error", text: w.error }]
+        : [{ role: "user", type: "user", text: w.question },
+           { ...w, id: crypto.randomUUID(), role: "assistant", type: "result" }])]);
+      fetchHistory();
+    } catch (err) {
+      setSuggestions(questions);
+      setMessages(prev => [...prev, { role: "assistant", type: "error", text: err.message }]);
+    }
+    setLoading(false);
+  }
+
+  function handleStop() {
+    if (queryIdRef.current) cancelQuery(queryIdRef.current);
+  }
+
   // ── Export ────────────────────────────────────────────────────────────
   async function handleExport(format, msg) {
     try {
-      await exportResults(format, msg.question, msg.sql, msg.summary, msg.rows || []);
+      await exportResults(format, session.session_id, msg.cursor_id,
+        msg.question, msg.sql, msg.summary, msg.rows || [],
+        { chart_type: msg.chart_type, x_key: msg.x_key, y_key: msg.y_key });
     } catch (err) {
       alert("Export failed: " + err.message);
     }
   }
 
+  // ── Table paging (pages are read from the server-side result) ───────
+  async function handlePage(index, msg, offset, sortBy = msg.sortBy, descending = msg.descending) {
+    if (!msg.cursor_id) return;  // previews can't be paged
+    try {
+      const page = await fetchPage(session.session_id, msg.cursor_id, offset, 10, sortBy, descending);
+      setMessages(prev => prev.map((m, i) => i === index
+        ? { ...m, pageRows: page.rows, pageOffset: offset, sortBy, descending }
+        : m));
+    } catch (err) {
+      alert("Could not load page: " + err.message);
+    }
+  }
+
   // ── Chart renderer ────────────────────────────────────────────────────
   function renderChart(msg) {
-    const { rows, chart_type, x_key, y_key, chart_title } = msg;
+    const { rows, chart, chart_type, x_key, y_key, chart_title } = msg;
     if (!rows?.length || chart_type === "none" || !x_key || !y_key) return null;
-    const data = rows.slice(0, 12).map(r => ({
+    // The server reduces the whole result to a chart series; previews
+    // (answered from a sample) only have their first rows
+    const points = chart ? chart.rows : rows.slice(0, 12);
+    const data = points.map(r => ({
       ...r,
       [y_key]: typeof r[y_key] === "number" ? parseFloat(r[y_key].toFixed(2)) : r[y_key]
     }));
@@ -134,11 +221,13 @@ export default function App() {
         <ResponsiveContainer width="100%" height={200}>
           <LineChart {...commonProps}>
             <CartesianGrid strokeDasharray="3 3" stroke="#1e293b" />
-            <XAxis dataKey={x_key} tick={tickStyle} angle={-30} textAnchor="end" interval={0} />
+            <XAxis dataKey={x_key} tick={tickStyle} angle={-30} textAnchor="end"
+              interval={data.length > 24 ? "preserveStartEnd" : 0} />
             <YAxis tick={tickStyle} tickFormatter={v => v > 999 ? `$${(v/1000).toFixed(0)}k` : v} />
             <Tooltip formatter={v => formatValue(v)} contentStyle={tooltipStyle} />
             <Line type="monotone" dataKey={y_key} stroke="#6366f1" strokeWidth={2.5}
-              dot={{ fill: "#6366f1", r: 4 }} activeDot={{ r: 6 }} />
+              dot={data.length > 50 ? false : { fill: "#6366f1", r: 4 }} activeDot={{ r: 6 }}
+              isAnimationActive={data.length <= 50} />
           </LineChart>
         </ResponsiveContainer>
       </div>
@@ -163,7 +252,10 @@ export default function App() {
   }
 
   // ── Table renderer ────────────────────────────────────────────────────
-  function renderTable(rows) {
+  function renderTable(msg, index) {
+    const rows   = msg.pageRows || msg.rows?.slice(0, 10);
+    const offset = msg.pageOffset || 0;
+    const total  = msg.total_rows ?? msg.rows?.length ?? 0;
     if (!rows?.length) return <p style={{ color: "#64748b", fontSize: 13 }}>No results.</p>;
     const cols = Object.keys(rows[0]);
     return (
@@ -172,12 +264,15 @@ export default function App() {
           <thead>
             <tr>{cols.map(c => (
               <th key={c} style={{ padding: "6px 12px", background: "#1e293b", color: "#94a3b8",
-                textAlign: "left", textTransform: "uppercase", fontSize: 11,
-                borderBottom: "1px solid #334155", letterSpacing: "0.05em" }}>{c}</th>
+                textAlign: "left", textTransform: "uppercase", fontSize: 11, cursor: "pointer",
+                borderBottom: "1px solid #334155", letterSpacing: "0.05em" }}
+                onClick={() => handlePage(index, msg, 0, c, msg.sortBy === c ? !msg.descending : false)}>
+                {c}{msg.sortBy === c ? (msg.descending ? " ↓" : " ↑") : ""}
+              </th>
             ))}</tr>
           </thead>
           <tbody>
-            {rows.slice(0,10).map((row,i) => (
+            {rows.map((row,i) => (
               <tr key={i} style={{ borderBottom: "1px solid #1e293b",
                 background: i % 2 === 0 ? "transparent" : "#0f172a33" }}>
                 {cols.map(c => (
@@ -187,9 +282,17 @@ export default function App() {
             ))}
           </tbody>
         </table>
-        {rows.length > 10 && (
+        {total > 10 && (
           <p style={{ color: "#475569", fontSize: 11, marginTop: 6, fontFamily: "monospace" }}>
-            Showing 10 of {rows.length} rows
+            Showing {offset + 1}–{offset + rows.length} of {total.toLocaleString()} rows
+            {offset > 0 && (
+              <button style={{ ...s.exportBtn, marginLeft: 8 }}
+                onClick={() => handlePage(index, msg, Math.max(0, offset - 10))}>← Prev</button>
+            )}
+            {offset + rows.length < total && (
+              <button style={{ ...s.exportBtn, marginLeft: 8 }}
+                onClick={() => handlePage(index, msg, offset + 10)}>Next →</button>
+            )}
           </p>
         )}
       </div>
@@ -289,10 +392,16 @@ export default function App() {
                 {showHistory ? "Hide History" : "Query History"}
               </button>
             )}
+            {session && (
+              <button style={s.histBtn} onClick={() => appendRef.current?.click()} disabled={uploading}>
+                Append CSV
+              </button>
+            )}
+            <input ref={appendRef} type="file" accept={UPLOAD_TYPES} style={{ display: "none" }} onChange={handleAppend} />
             <button style={s.uploadBtn} onClick={() => fileRef.current?.click()}>
               {uploading ? "Uploading…" : session ? "Upload New CSV" : "Upload CSV"}
             </button>
-            <input ref={fileRef} type="file" accept=".csv" style={{ display: "none" }} onChange={handleUpload} />
+            <input ref={fileRef} type="file" accept={UPLOAD_TYPES} style={{ display: "none" }} onChange={handleUpload} />
           </div>
         </div>
 
@@ -330,7 +439,7 @@ export default function App() {
                     Welcome to QueryMind
                   </div>
                   <div style={{ fontSize: 14, color: "#334155" }}>
-                    Upload a CSV file to get started
+                    Upload a CSV, Parquet, NDJSON or Excel file to get started
                   </div>
                   <button style={{ ...s.uploadBtn, marginTop: 24, padding: "10px 28px", fontSize: 14 }}
                     onClick={() => fileRef.current?.click()}>
@@ -360,6 +469,7 @@ export default function App() {
                   <div key={i} style={s.errorBubble}>⚠️ {msg.text}</div>
                 );
                 if (msg.type === "result") {
+                  if (msg.streaming && !msg.sql) return null;
                   const hasChart = msg.chart_type !== "none" && msg.x_key && msg.y_key && msg.rows?.length;
                   return (
                     <div key={i} style={s.aiBubble}>
@@ -374,8 +484,16 @@ export default function App() {
                       )}
 
                       <div style={{ marginTop: hasChart ? 16 : 0 }}>
-                        <div style={s.label}>Results ({msg.rows?.length} row{msg.rows?.length !== 1 ? "s" : ""})</div>
-                        {renderTable(msg.rows)}
+                        <div style={s.label}>Results ({(msg.total_rows ?? 0).toLocaleString()} row{msg.total_rows !== 1 ? "s" : ""})</div>
+                        {msg.approximate && (
+                          <p style={{ color: "#f59e0b", fontSize: 11, fontFamily: "monospace", margin: "4px 0" }}>
+                            ≈ Preview from a {(msg.approximate.sample_fraction * 100).toFixed(1)}% sample
+                            (±{(msg.approximate.relative_error * 100).toFixed(1)}%{msg.approximate.distinct_is_lower_bound ? ", distinct counts are lower bounds" : ""}) — refining…
+                          </p>
+                        )}
+                        {msg.streaming && !msg.cursor_id && !msg.approximate
+                          ? <p style={{ color: "#475569", fontSize: 12, fontFamily: "monospace" }}>⟳ Running query…</p>
+                          : renderTable(msg, i)}
                       </div>
 
                       <div style={s.divider} />
@@ -386,6 +504,9 @@ export default function App() {
                         <button style={s.exportBtn} onClick={() => handleExport("csv", msg)}>
                           ↓ Export CSV
                         </button>
+                        <button style={s.exportBtn} onClick={() => handleExport("parquet", msg)}>
+                          ↓ Export Parquet
+                        </button>
                         <button style={s.exportBtn} onClick={() => handleExport("pdf", msg)}>
                           ↓ Export PDF
                         </button>
@@ -396,7 +517,7 @@ export default function App() {
                 return null;
               })}
 
-              {loading && (
+              {loading && !messages.some(m => m.streaming && m.sql) && (
                 <div style={{ ...s.aiBubble, color: "#475569" }}>
                   <span style={{ fontFamily: "monospace", fontSize: 13 }}>
                     ⟳ Translating to SQL and running query…
@@ -423,6 +544,12 @@ export default function App() {
                       {sg}
                     </button>
                   ))}
+                  {suggestions.length > 1 && (
+                    <button style={{ ...s.suggBtn, color: "#6366f1", borderColor: "#6366f1" }}
+                      disabled={loading} onClick={handleAnswerAll}>
+                      Answer all
+                    </button>
+                  )}
                 </div>
               )}
               <div style={s.inputRow}>
@@ -431,9 +558,14 @@ export default function App() {
                   onKeyDown={e => e.key === "Enter" && handleSubmit()}
                   placeholder="Ask anything about your data…"
                   disabled={loading} />
-                <button style={{ ...s.sendBtn, opacity: loading ? 0.5 : 1 }}
-                  onClick={() => handleSubmit()} disabled={loading}>
-                  {loading ? "…" : "Run →"}
+                <label style={{ display: "flex", alignItems: "center", gap: 4, fontSize: 12, color: "#94a3b8", fontFamily: "monospace", whiteSpace: "nowrap" }}
+                  title="On large datasets, show a quick answer from a sample first">
+                  <input type="checkbox" checked={approximate} onChange={e => setApproximate(e.target.checked)} />
+                  Fast preview
+                </label>
+                <button style={s.sendBtn}
+                  onClick={() => loading ? handleStop() : handleSubmit()}>
+                  {loading ? "Stop" : "Run →"}
                 </button>
               </div>
             </div>
@@ -1,43 +1,166 @@
 const BASE = import.meta.env.VITE_API_URL;
  
-export async function uploadCSV(file) {
+async function postFile(url, file, onProgress) {
   const form = new FormData();
   form.append('file', file);
-  const res = await fetch(`${BASE}/upload`,
-      { method: 'POST', body: form });
-  return res.json();
+  const uploadId = crypto.randomUUID();
+  const timer = onProgress && setInterval(async () => {
+    const res = await fetch(`${BASE}/upload/${uploadId}/progress`);
+    if (res.ok) onProgress(await res.json());
+  }, 500);
+  try {
+    const res = await fetch(`${url}?upload_id=${uploadId}`,
+        { method: 'POST', body: form });
+    const result = await res.json();
+    if (!res.ok) throw new Error(result.detail || res.statusText);
+    return result;
+  } finally {
+    if (timer) clearInterval(timer);
+  }
+}
+
+export function uploadCSV(file, onProgress) {
+  return postFile(`${BASE}/upload`, file, onProgress);
+}
+
+// Add the rows of another CSV with the same columns to the session
+export function appendCSV(sessionId, file, onProgress) {
+  return postFile(`${BASE}/upload/${sessionId}/append`, file, onProgress);
 }
  
-export async function runQuery(
-    sessionId, question, schema, sample, rowCount) {
+// Results come back as typed columns; the UI works with row objects
+export function toRows({ columns = [], data = [] }) {
+  const n = data.length ? data[0].length : 0;
+  return Array.from({ length: n }, (_, i) =>
+    Object.fromEntries(columns.map((c, j) => [c.name, data[j][i]])));
+}
+
+export async function runQuery(sessionId, question) {
   const res = await fetch(`${BASE}/query`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ session_id: sessionId, question })
+  });
+  const result = await res.json();
+  const chart = result.chart && { ...result.chart, rows: toRows(result.chart) };
+  return { ...result, rows: toRows(result), chart };
+}
+ 
+// Streaming variant of runQuery: calls onEvent for each NDJSON event
+// (started, sql, meta, preview, rows, chart, summary, done) as soon as the
+// server sends it. Pass the same queryId to cancelQuery to stop the run.
+// With approximate, large datasets get a sampled preview before the exact
+// rows.
+export async function runQueryStream(
+    sessionId, question, onEvent, queryId, approximate = false) {
+  const res = await fetch(`${BASE}/query/stream`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({
-      session_id: sessionId, question,
-      schema, sample, row_count: rowCount
+      session_id: sessionId, question, query_id: queryId, approximate
     })
   });
-  return res.json();
+  const reader  = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const event = JSON.parse(line);
+      if (event.type === 'error') throw new Error(event.detail);
+      if (event.type === 'rows' || event.type === 'preview' ||
+          event.type === 'chart') {
+        event.rows = toRows(event);
+      }
+      onEvent(event);
+    }
+  }
 }
- 
+
+// Answer several questions at once (e.g. all suggestions): one widget per
+// question, each like a runQuery result or { question, error }
+export async function runDashboard(sessionId, questions) {
+  const res = await fetch(`${BASE}/dashboard`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ session_id: sessionId, questions })
+  });
+  const result = await res.json();
+  if (!res.ok) throw new Error(result.detail || res.statusText);
+  return result.widgets.map(w => w.error ? w : {
+    ...w, rows: toRows(w),
+    chart: w.chart && { ...w.chart, rows: toRows(w.chart) }
+  });
+}
+
+export async function cancelQuery(queryId) {
+  await fetch(`${BASE}/query/cancel`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ query_id: queryId })
+  });
+}
+
+export async function fetchPage(
+    sessionId, cursorId, offset, limit, sortBy, descending, filters) {
+  const res = await fetch(`${BASE}/cursor/page`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      session_id: sessionId, cursor_id: cursorId, offset, limit,
+      sort_by: sortBy, descending, filters: filters || []
+    })
+  });
+  const page = await res.json();
+  return { ...page, rows: toRows(page) };
+}
+
 export async function getHistory(sessionId) {
   const res = await fetch(`${BASE}/history/${sessionId}`);
   return res.json();
 }
  
 export async function exportResults(
-    format, question, sql, summary, rows) {
-  const res = await fetch(`${BASE}/export`, {
-    method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ format, question, sql, summary, rows })
+    format, sessionId, cursorId, question, sql, summary, rows, chart) {
+  // Everything is exported from the full server-side result; rows are
+  // only used for a PDF when there is no stored result
+  const body = JSON.stringify({
+    format, question, sql, summary,
+    session_id: sessionId, cursor_id: cursorId,
+    rows: format === 'pdf' && !cursorId ? rows : [],
+    ...(chart || {})
   });
+  const res = format === 'pdf'
+    ? await fetch(await renderReport(body))
+    : await fetch(`${BASE}/export`, {
+        method: 'POST', headers: { 'Content-Type': 'application/json' }, body
+      });
+  if (!res.ok) throw new Error(res.statusText);
   const blob = await res.blob();
   const url  = URL.createObjectURL(blob);
   const a    = document.createElement('a');
   a.href     = url;
-  a.download = format === 'csv' ? 'results.csv' : 'report.pdf';
+  a.download = format === 'pdf' ? 'report.pdf' : `results.${format}`;
   a.click();
 }
 
+// PDF reports are rendered in the background: start one, wait until it
+// is done and return its download URL
+async function renderReport(body) {
+  const res = await fetch(`${BASE}/reports`, {
+    method: 'POST', headers: { 'Content-Type': 'application/json' }, body
+  });
+  let report = await res.json();
+  if (!res.ok) throw new Error(report.detail || res.statusText);
+  while (report.status === 'running') {
+    await new Promise(resolve => setTimeout(resolve, 500));
+    report = await (await fetch(`${BASE}/reports/${report.report_id}`)).json();
+  }
+  if (report.status !== 'done') throw new Error(report.error || 'Report failed');
+  return `${BASE}/reports/${report.report_id}/pdf`;
+}